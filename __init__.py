@@ -5,12 +5,20 @@ from .service import *
 from .account import *
 from .party import *
 from .address import *
+from .change import *
+from .job import *
+from .catalog import *
+from .archive import *
+from .service_calendar import *
+from .branch import *
+from .revenue import *
 
 def register():
     Pool.register(
         FiscalYear,
         Period,
         Periferic,
+        ServicePhoto,
         Service,
         ServiceLine,
         HistoryLine,
@@ -18,6 +26,22 @@ def register():
         Company,
         DraftServiceStart,
         Address,
+        ServiceChange,
+        ServiceJob,
+        ProductBrand,
+        Template,
+        Product,
+        Employee,
+        Translation,
+        ServiceArchive,
+        ServiceLineArchive,
+        HistoryLineArchive,
+        ServiceCalendar,
+        ServiceCalendarHoliday,
+        ServiceBranch,
+        User,
+        ServiceRevenueDirty,
+        ServiceRevenueRollup,
         module='nodux_technical_service', type_='model')
     Pool.register(
         ServiceReport,
@@ -72,7 +72,9 @@ class FiscalYear:
 
     @classmethod
     def write(cls, *args):
-        Service = Pool().get('service.service')
+        pool = Pool()
+        Service = pool.get('service.service')
+        Archive = pool.get('service.service.archive')
         actions = iter(args)
         for fiscalyears, values in zip(actions, actions):
             for sequence in ('service_sequence', 'home_service_sequence'):
@@ -82,14 +84,14 @@ class FiscalYear:
                     if (getattr(fiscalyear, sequence)
                             and (getattr(fiscalyear, sequence).id !=
                                 values[sequence])):
-                        if Service.search([
-                                    ('entry_date', '>=',
-                                        fiscalyear.start_date),
-                                    ('entry_date', '<=',
-                                        fiscalyear.end_date),
-                                    ('number_service', '!=', None),
-                                    ('type', '=', sequence[:-9]),
-                                    ]):
+                        domain = [
+                            ('entry_date', '>=', fiscalyear.start_date),
+                            ('entry_date', '<=', fiscalyear.end_date),
+                            ('number_service', '!=', None),
+                            ('type', '=', sequence[:-9]),
+                            ]
+                        if (Service.search(domain, limit=1)
+                                or Archive.search(domain, limit=1)):
                             cls.raise_user_error('change_service_sequence',
                                 (fiscalyear.rec_name,))
         super(FiscalYear, cls).write(*args)
@@ -170,7 +172,9 @@ class Period:
 
     @classmethod
     def write(cls, *args):
-        Service = Pool().get('service.service')
+        pool = Pool()
+        Service = pool.get('service.service')
+        Archive = pool.get('service.service.archive')
 
         actions = iter(args)
         for periods, values in zip(actions, actions):
@@ -180,17 +184,24 @@ class Period:
                 for period in periods:
                     sequence = getattr(period, sequence_name)
                     if (sequence and sequence.id != values[sequence_name]):
-                        if Service.search([
-                                    ('entry_date', '>=', period.start_date),
-                                    ('entry_date', '<=', period.end_date),
-                                    ('number_service', '!=', None),
-                                    ('type', '=', sequence_name[:-9]),
-                                    ]):
+                        domain = [
+                            ('entry_date', '>=', period.start_date),
+                            ('entry_date', '<=', period.end_date),
+                            ('number_service', '!=', None),
+                            ('type', '=', sequence_name[:-9]),
+                            ]
+                        if (Service.search(domain, limit=1)
+                                or Archive.search(domain, limit=1)):
                             cls.raise_user_error('change_service_sequence',
                                 (period.rec_name,))
         super(Period, cls).write(*args)
 
-    def get_service_sequence(self, invoice_type):
+    def get_service_sequence(self, invoice_type, branch=None):
+        'Return the sequence of the branch, of the period or of the year'
+        if branch:
+            sequence = getattr(branch, invoice_type + '_sequence')
+            if sequence:
+                return sequence
         sequence = getattr(self, invoice_type + '_sequence')
         if sequence:
             return sequence
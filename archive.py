@@ -0,0 +1,384 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+import datetime
+from collections import defaultdict
+from decimal import Decimal
+from sql.aggregate import Max
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.cache import Cache
+from trytond.config import config
+from trytond import backend
+from .fingerprint import backfill_fingerprint
+from .fts import FTS_FIELDS, register_fts_index
+
+__all__ = ['ServiceArchive', 'ServiceLineArchive', 'HistoryLineArchive',
+    'search_archive']
+
+_TYPE = [
+    ('service', 'Servicio'),
+    ('home_service', 'Servicio a domicilio')
+]
+
+
+def _archive_cutoff():
+    'Return the entry date before which delivered services are archived'
+    Date = Pool().get('ir.date')
+    days = config.getint('nodux_technical_service', 'archive_days',
+        default=730)
+    if not days:
+        return None
+    return Date.today() - datetime.timedelta(days=days)
+
+
+def search_archive(domain):
+    '''
+    Test if domain may match archived services: it asks for delivered
+    services or for entry dates before the archive cutoff.
+    '''
+    if not Transaction().context.get('service_archive', True):
+        return False
+    cutoff = _archive_cutoff()
+    if not cutoff:
+        return False
+
+    def test(clause):
+        if not clause or isinstance(clause, basestring):
+            return False
+        if isinstance(clause, (list, tuple)) and isinstance(clause[0],
+                basestring) and len(clause) >= 3:
+            name, operator, value = clause[:3]
+            if name == 'state':
+                if operator == '=':
+                    return value == 'delivered'
+                if operator == 'in':
+                    return 'delivered' in value
+            elif name == 'entry_date' and isinstance(value, datetime.date):
+                if operator in ('<', '<=', '='):
+                    return value < cutoff
+            return False
+        return any(test(c) for c in clause)
+    return test(domain)
+
+
+class ArchiveMixin(object):
+    '''
+    Read-only copy of the rows of a hot model.
+    On PostgreSQL the table is the parent of a child table per year of entry
+    date so queries restricted on year only scan the matching partitions.
+    '''
+    _archive_source = None
+    _archive_key = 'id'
+    _max_id_cache = None
+
+    year = fields.Integer('Year', readonly=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ArchiveMixin, cls).__setup__()
+        for method in ('create', 'write', 'delete'):
+            cls.__rpc__.pop(method, None)
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(ArchiveMixin, cls).__register__(module_name)
+        if cls.__name__ in FTS_FIELDS:
+            register_fts_index(cls)
+        for table in cls.partitions():
+            cls.index_partition(table)
+
+    @classmethod
+    def partitions(cls):
+        'Return the child tables of the archive'
+        if backend.name() != 'postgresql':
+            return []
+        cursor = Transaction().cursor
+        cursor.execute('SELECT c.relname FROM pg_inherits i '
+            'JOIN pg_class c ON c.oid = i.inhrelid '
+            'JOIN pg_class p ON p.oid = i.inhparent '
+            'WHERE p.relname = %s', (cls._table,))
+        return [r[0] for r in cursor.fetchall()]
+
+    @classmethod
+    def partition(cls, year):
+        'Return the table in which the rows of year are stored'
+        if backend.name() != 'postgresql':
+            return cls._table
+        cursor = Transaction().cursor
+        name = '%s_%s' % (cls._table, int(year))
+        cursor.execute('SELECT 1 FROM pg_class WHERE relname = %s', (name,))
+        if not cursor.fetchone():
+            cursor.execute('CREATE TABLE "%s" (CHECK ("year" = %s)) '
+                'INHERITS ("%s")' % (name, int(year), cls._table))
+            cls.index_partition(name)
+        return name
+
+    @classmethod
+    def index_partition(cls, name):
+        '''
+        Create on the partition name the indexes of the archive table as
+        they are not inherited: id, the selected fields and full-text.
+        '''
+        cursor = Transaction().cursor
+        columns = [('id', True)] + [(n, False)
+            for n, f in sorted(cls._fields.iteritems())
+            if getattr(f, 'select', False) and n != 'id'
+            and not isinstance(f, (fields.Function, fields.One2Many,
+                    fields.Many2Many))]
+        for column, unique in columns:
+            index = '%s_%s_index' % (name, column)
+            cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s',
+                (index,))
+            if cursor.fetchone():
+                continue
+            cursor.execute('CREATE %sINDEX "%s" ON "%s" ("%s")' % (
+                    'UNIQUE ' if unique else '', index, name, column))
+        if cls.__name__ in FTS_FIELDS:
+            register_fts_index(cls, name)
+
+    @classmethod
+    def archive_columns(cls):
+        'Return the columns copied from the hot table'
+        TableHandler = backend.get('TableHandler')
+        Source = Pool().get(cls._archive_source)
+        table = TableHandler(Transaction().cursor, Source)
+        columns = ['id', 'create_uid', 'create_date', 'write_uid',
+            'write_date']
+        for name, field in cls._fields.iteritems():
+            if (name in columns or name == 'year'
+                    or isinstance(field, (fields.Function, fields.One2Many,
+                            fields.Many2Many))):
+                continue
+            if table.column_exist(name):
+                columns.append(name)
+        return columns
+
+    @classmethod
+    def copy_rows(cls, year, service_ids):
+        'Copy the rows of the hot table belonging to service_ids'
+        Source = Pool().get(cls._archive_source)
+        cursor = Transaction().cursor
+        columns = ', '.join('"%s"' % c for c in cls.archive_columns())
+        cursor.execute('INSERT INTO "%s" (%s, "year") '
+            'SELECT %s, %%s FROM "%s" WHERE "%s" IN (%s)' % (
+                cls.partition(year), columns, columns, Source._table,
+                cls._archive_key, ','.join('%s' for _ in service_ids)),
+            [year] + list(service_ids))
+        cursor.execute('DELETE FROM "%s" WHERE "%s" IN (%s)' % (
+                Source._table, cls._archive_key,
+                ','.join('%s' for _ in service_ids)), list(service_ids))
+
+    @classmethod
+    def archived_ids(cls, ids):
+        'Return the ids among ids that are archived'
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        max_id = cls._max_id_cache.get(None)
+        if max_id is None:
+            cursor.execute(*table.select(Max(table.id)))
+            row = cursor.fetchone()
+            max_id = row[0] if row and row[0] else 0
+            cls._max_id_cache.set(None, max_id)
+        candidates = [i for i in ids if i <= max_id]
+        archived = set()
+        for i in range(0, len(candidates), cursor.IN_MAX):
+            sub_ids = candidates[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(table.id,
+                    where=table.id.in_(sub_ids)))
+            archived.update(r[0] for r in cursor.fetchall())
+        return archived
+
+    @classmethod
+    def read_with_archive(cls, Source, ids, fields_names, read):
+        '''
+        Read ids with read, the read method of the hot model, and the ids
+        that are archived from the archive with the same field names.
+        '''
+        archived = cls.archived_ids(ids) if ids else set()
+        if not archived:
+            return read(ids, fields_names)
+        hot_ids = [i for i in ids if i not in archived]
+        result = read(hot_ids, fields_names) if hot_ids else []
+        names = fields_names or Source._fields.keys()
+        archive_names = [n for n in names if n in cls._fields]
+        for values in cls.read(list(archived), archive_names):
+            for name in names:
+                values.setdefault(name, None)
+            result.append(values)
+        return result
+
+
+class ServiceArchive(ArchiveMixin, ModelSQL, ModelView):
+    'Service Archive'
+    __name__ = 'service.service.archive'
+    _archive_source = 'service.service'
+    _max_id_cache = Cache('service.service.archive.max_id', context=False)
+
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    party = fields.Many2One('party.party', 'Party', readonly=True)
+    number_service = fields.Char('No. Comprobante', readonly=True)
+    type = fields.Selection(_TYPE, 'Type', readonly=True)
+    total = fields.Function(fields.Numeric('Total'), 'get_amount')
+    entry_date = fields.Date('Entry Date', readonly=True)
+    delivery_date = fields.Date('Estimated Delivery Date', readonly=True)
+    technical = fields.Many2One('company.employee', 'Technical',
+        readonly=True)
+    branch = fields.Many2One('service.branch', 'Branch', readonly=True)
+    garanty = fields.Boolean('Garanty', readonly=True)
+    new = fields.Boolean('New', readonly=True)
+    lined = fields.Boolean('Lined', readonly=True)
+    beaten = fields.Boolean('Beaten', readonly=True)
+    broken = fields.Boolean('Broken', readonly=True)
+    stained = fields.Boolean('Stained', readonly=True)
+    invoice_date = fields.Date('Invoice Date', readonly=True)
+    invoice_number = fields.Char('Invoice number', readonly=True)
+    case_number = fields.Char('Case number', readonly=True)
+    send_date = fields.Date('Send Date', readonly=True)
+    remission = fields.Char('No. guide remission', readonly=True)
+    transport = fields.Char('Transport', readonly=True)
+    photo = fields.Function(fields.Binary('Foto', readonly=True),
+        'get_photo')
+    state = fields.Selection([
+            ('delivered', 'Delivered'),
+            ], 'State', readonly=True)
+    lines = fields.One2Many('service.service.line.archive', 'service',
+        'Lines', readonly=True)
+    accessories = fields.Text('Accessories', readonly=True)
+    observations = fields.Text('Observations', readonly=True)
+    history_lines = fields.One2Many('service.service.history_lines.archive',
+        'service', 'Lines', readonly=True)
+    total_home_service = fields.Numeric('Total', readonly=True)
+    state_date = fields.Function(fields.Char('State Date'),
+        'get_state_date')
+    detail = fields.Text('Repair Detail', readonly=True)
+    intake_reference = fields.Char('Intake Reference', readonly=True,
+        select=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+        photo_exist = table.column_exist('photo')
+
+        super(ServiceArchive, cls).__register__(module_name)
+
+        # Migration: photo moved to service.service.photo
+        if photo_exist:
+            Pool().get('service.service.photo').move_column(cls._table)
+            table.drop_column('photo')
+
+    @classmethod
+    def get_photo(cls, services, name):
+        Photo = Pool().get('service.service.photo')
+        return Photo.get_photos([s.id for s in services])
+
+    @classmethod
+    def get_amount(cls, services, name):
+        return dict((s.id, sum((l.reference_amount or Decimal(0)
+                        for l in s.lines), Decimal(0)))
+            for s in services)
+
+    @classmethod
+    def get_state_date(cls, services, name):
+        return dict((s.id, '') for s in services)
+
+    @classmethod
+    def archive(cls):
+        '''
+        Move the delivered services older than the archive_days option to
+        the archive with their lines and history lines.
+        '''
+        pool = Pool()
+        Service = pool.get('service.service')
+        LineArchive = pool.get('service.service.line.archive')
+        HistoryArchive = pool.get('service.service.history_lines.archive')
+        cursor = Transaction().cursor
+        table = Service.__table__()
+
+        cutoff = _archive_cutoff()
+        if not cutoff:
+            return
+        batch = config.getint('nodux_technical_service', 'archive_batch',
+            default=1000)
+        while True:
+            cursor.execute(*table.select(table.id, table.entry_date,
+                    where=(table.state == 'delivered')
+                    & (table.entry_date < cutoff),
+                    limit=batch))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            years = defaultdict(list)
+            for service_id, entry_date in rows:
+                if isinstance(entry_date, basestring):
+                    entry_date = datetime.date(*map(int,
+                            entry_date.split('-')))
+                years[entry_date.year].append(service_id)
+            for year, service_ids in years.iteritems():
+                # Children first as the hot tables cascade on service
+                for Archive in (HistoryArchive, LineArchive, cls):
+                    Archive.copy_rows(year, service_ids)
+            for Archive in (HistoryArchive, LineArchive, cls):
+                Archive._max_id_cache.clear()
+            cursor.commit()
+
+
+class ServiceLineArchive(ArchiveMixin, ModelSQL, ModelView):
+    'Service Line Archive'
+    __name__ = 'service.service.line.archive'
+    _archive_source = 'service.service.line'
+    _archive_key = 'service'
+    _max_id_cache = Cache('service.service.line.archive.max_id',
+        context=False)
+
+    service = fields.Many2One('service.service.archive', 'Service',
+        readonly=True, select=True)
+    product = fields.Many2One('product.product', 'Type Work', readonly=True)
+    periferic = fields.Many2One('service.periferic', 'Periferic',
+        readonly=True)
+    periferic_name = fields.Function(fields.Char('Periferic'),
+        'get_periferic_name')
+    trademark = fields.Many2One('product.brand', 'Trademark', readonly=True)
+    model = fields.Char('Model', readonly=True)
+    series = fields.Char('Series', readonly=True)
+    fingerprint = fields.Char('Fingerprint', readonly=True, select=True)
+    failure = fields.Text('Failure', readonly=True)
+    reference_amount = fields.Numeric('Reference Amount', readonly=True)
+    technical = fields.Many2One('company.employee', 'Technical',
+        readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        table = TableHandler(Transaction().cursor, cls, module_name)
+        fingerprint_exist = table.column_exist('fingerprint')
+
+        super(ServiceLineArchive, cls).__register__(module_name)
+
+        if not fingerprint_exist:
+            backfill_fingerprint(cls)
+
+    @classmethod
+    def get_periferic_name(cls, lines, name):
+        Periferic = Pool().get('service.periferic')
+        names = Periferic.get_name_catalog()
+        return dict((l.id, names.get(l.periferic.id) if l.periferic else None)
+            for l in lines)
+
+
+class HistoryLineArchive(ArchiveMixin, ModelSQL, ModelView):
+    'History Line Archive'
+    __name__ = 'service.service.history_lines.archive'
+    _archive_source = 'service.service.history_lines'
+    _archive_key = 'service'
+    _max_id_cache = Cache('service.service.history_lines.archive.max_id',
+        context=False)
+
+    service = fields.Many2One('service.service.archive', 'Service',
+        readonly=True, select=True)
+    description = fields.Text('Description', readonly=True)
+    date = fields.DateTime('Hora', readonly=True)
+    user = fields.Char('Usuario', readonly=True)
+    password = fields.Char('Password', readonly=True)
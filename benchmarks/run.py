@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+'''
+Benchmark of the hot paths of nodux_technical_service.
+
+It installs the module in the test database of trytond, fills it with
+synthetic data and reports the wall time, the number of queries and the
+rows fetched by each operation. Each operation is rolled back after being
+measured so repetitions run against the same data.
+
+    DB_NAME=:memory: python benchmarks/run.py --parties 20
+    DB_NAME=bench python benchmarks/run.py --save
+'''
+import datetime
+import json
+import optparse
+import os
+import sys
+import time
+from decimal import Decimal
+
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT, \
+    install_module
+from trytond.transaction import Transaction
+from trytond.modules.nodux_technical_service.instrument import QueryCounter
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'baseline.json')
+
+
+def setup_data(options):
+    'Create the company, fiscal year, catalogs and services'
+    pool = POOL
+    ModelData = pool.get('ir.model.data')
+    User = pool.get('res.user')
+    Currency = pool.get('currency.currency')
+    Party = pool.get('party.party')
+    Company = pool.get('company.company')
+    Employee = pool.get('company.employee')
+    Sequence = pool.get('ir.sequence')
+    SequenceStrict = pool.get('ir.sequence.strict')
+    FiscalYear = pool.get('account.fiscalyear')
+    Template = pool.get('product.template')
+    Brand = pool.get('product.brand')
+    Periferic = pool.get('service.periferic')
+    Service = pool.get('service.service')
+    Date = pool.get('ir.date')
+
+    currency, = Currency.create([{
+                'name': 'Dolar',
+                'code': 'USD',
+                'symbol': '$',
+                }])
+    company_party, = Party.create([{'name': 'Nodux'}])
+    company, = Company.create([{
+                'party': company_party.id,
+                'currency': currency.id,
+                }])
+    admin = User(USER)
+    User.write([admin], {
+            'main_company': company.id,
+            'company': company.id,
+            'password': 'admin',
+            })
+
+    with Transaction().set_context(company=company.id):
+        today = Date.today()
+        move_sequence, = Sequence.create([{
+                    'name': 'Move',
+                    'code': 'account.move',
+                    'company': company.id,
+                    }])
+        service_sequence, home_service_sequence = SequenceStrict.create([{
+                    'name': name,
+                    'code': 'service.service',
+                    'company': company.id,
+                    } for name in ('Service', 'Home Service')])
+        fiscalyear, = FiscalYear.create([{
+                    'name': str(today.year),
+                    'start_date': today.replace(month=1, day=1),
+                    'end_date': today.replace(month=12, day=31),
+                    'company': company.id,
+                    'post_move_sequence': move_sequence.id,
+                    'service_sequence': service_sequence.id,
+                    'home_service_sequence': home_service_sequence.id,
+                    }])
+        FiscalYear.create_period([fiscalyear])
+
+        technicals = Employee.create([{
+                    'party': Party.create([{'name': 'Tecnico %s' % i}])[0].id,
+                    'company': company.id,
+                    } for i in range(5)])
+        unit = ModelData.get_id('product', 'uom_unit')
+        templates = Template.create([{
+                    'name': 'Trabajo %s' % i,
+                    'type': 'service',
+                    'list_price': Decimal(20),
+                    'cost_price': Decimal(10 + i),
+                    'default_uom': unit,
+                    'products': [('create', [{}])],
+                    } for i in range(10)])
+        products = sum((list(t.products) for t in templates), [])
+        brands = Brand.create([{'name': 'Marca %s' % i} for i in range(10)])
+        periferics = Periferic.create([{'name': 'Periferico %s' % i}
+                for i in range(10)])
+
+        parties = Party.create([{
+                    'name': 'Cliente %s' % i,
+                    'vat_number': '%010d' % i,
+                    } for i in range(options.parties)])
+        vlist = []
+        for party in parties:
+            for i in range(options.services):
+                vlist.append({
+                        'party': party.id,
+                        'company': company.id,
+                        'entry_date': today,
+                        'delivery_date': today + datetime.timedelta(days=1),
+                        'observations': 'no enciende',
+                        'lines': [('create', [{
+                                        'product': products[j % 10].id,
+                                        'periferic': periferics[j % 10].id,
+                                        'trademark': brands[j % 10].id,
+                                        'model': 'M%s' % j,
+                                        'failure': 'no enciende',
+                                        'reference_amount': Decimal(15),
+                                        'technical': technicals[j % 5].id,
+                                        } for j in range(options.lines)])],
+                        'history_lines': [('create', [{
+                                        'description': 'revision %s' % j,
+                                        'user': 'admin',
+                                        'password': 'admin',
+                                        } for j in range(options.notes)])],
+                        })
+        Service.create(vlist)
+    return company, parties
+
+
+def get_operations(company, parties):
+    'Return the (name, function) pairs to measure'
+    pool = POOL
+    Service = pool.get('service.service')
+    HistoryLine = pool.get('service.service.history_lines')
+    Period = pool.get('account.period')
+    FiscalYear = pool.get('account.fiscalyear')
+    SequenceStrict = pool.get('ir.sequence.strict')
+    ServiceReport = pool.get('service.service', type='report')
+
+    def review():
+        Service.review(Service.search([('state', '=', 'pending')]))
+
+    def tree_read():
+        services = Service.search([])
+        Service.read([s.id for s in services], ['total', 'state_date'])
+
+    def technical_service():
+        for party in parties[:10]:
+            Service.getTechnicalService(party.vat_number)
+
+    def report():
+        service = Service.search([], limit=1)[0]
+        ServiceReport.execute([service.id], {})
+
+    def on_change_password():
+        line = HistoryLine()
+        line.description = 'revision'
+        line.password = 'admin'
+        line.on_change_password()
+
+    def sequence_guards():
+        sequence, = SequenceStrict.create([{
+                    'name': 'Guard',
+                    'code': 'service.service',
+                    'company': company.id,
+                    }])
+        periods = Period.search([('type', '=', 'standard')])
+        Period.write(periods, {'home_service_sequence': sequence.id})
+        FiscalYear.write(FiscalYear.search([]), {
+                'home_service_sequence': sequence.id,
+                })
+
+    return [
+        ('review', review),
+        ('tree_read', tree_read),
+        ('getTechnicalService', technical_service),
+        ('report', report),
+        ('on_change_password', on_change_password),
+        ('sequence_guards', sequence_guards),
+        ]
+
+
+def measure(function, repeat):
+    'Return the median wall time in ms, queries and rows of function'
+    cursor = Transaction().cursor
+    results = []
+    for _ in range(repeat):
+        Transaction().cache.clear()
+        with QueryCounter() as counter:
+            start = time.time()
+            function()
+            wall = (time.time() - start) * 1000
+        cursor.rollback()
+        results.append((wall, counter.queries, counter.rows))
+    results.sort()
+    return results[len(results) // 2]
+
+
+def compare(results, baseline, threshold):
+    'Print the results against the baseline and return the regressions'
+    regressions = []
+    print '%-22s %10s %8s %8s %10s' % ('operation', 'ms', 'queries', 'rows',
+        'baseline')
+    for name, (wall, queries, rows) in results:
+        reference = baseline.get(name)
+        note = ''
+        if reference:
+            note = '%.1f/%s' % (reference['ms'], reference['queries'])
+            if (queries > reference['queries']
+                    or wall > reference['ms'] * (1 + threshold)):
+                regressions.append(name)
+                note += ' !'
+        print '%-22s %10.1f %8s %8s %10s' % (name, wall, queries, rows, note)
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--parties', type='int', default=20)
+    parser.add_option('--services', type='int', default=5,
+        help='services per party')
+    parser.add_option('--lines', type='int', default=3,
+        help='lines per service')
+    parser.add_option('--notes', type='int', default=2,
+        help='history lines per service')
+    parser.add_option('--repeat', type='int', default=5)
+    parser.add_option('--baseline', default=BASELINE)
+    parser.add_option('--threshold', type='float', default=0.2,
+        help='allowed wall time increase over the baseline')
+    parser.add_option('--save', action='store_true',
+        help='store the results as the new baseline')
+    options, _ = parser.parse_args()
+
+    install_module('nodux_technical_service')
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        company, parties = setup_data(options)
+        transaction.cursor.commit()
+        with transaction.set_context(company=company.id):
+            results = [(name, measure(function, options.repeat))
+                for name, function in get_operations(company, parties)]
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as fp:
+            baseline = json.load(fp)
+    regressions = compare(results, baseline, options.threshold)
+    if options.save:
+        with open(options.baseline, 'w') as fp:
+            json.dump(dict((name, {
+                            'ms': wall,
+                            'queries': queries,
+                            'rows': rows,
+                            }) for name, (wall, queries, rows) in results),
+                fp, indent=4, sort_keys=True)
+    return 1 if regressions and not options.save else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
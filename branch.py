@@ -0,0 +1,150 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pyson import Eval
+from trytond.pool import PoolMeta, Pool
+from trytond.transaction import Transaction
+
+__all__ = ['ServiceBranch', 'User']
+__metaclass__ = PoolMeta
+
+
+class ServiceBranch(ModelSQL, ModelView):
+    'Service Branch'
+    __name__ = 'service.branch'
+    name = fields.Char('Name', required=True)
+    company = fields.Many2One('company.company', 'Company', required=True,
+        select=True)
+    service_sequence = fields.Many2One('ir.sequence.strict',
+        'Service Sequence',
+        domain=[
+            ('code', '=', 'service.service'),
+            ['OR',
+                ('company', '=', Eval('company')),
+                ('company', '=', None),
+                ],
+            ],
+        context={
+            'code': 'service.service',
+            'company': Eval('company'),
+            },
+        depends=['company'],
+        help='Numbers the services of the branch in every fiscal year, it '
+        'is never reset')
+    home_service_sequence = fields.Many2One('ir.sequence.strict',
+        'Home Service Sequence',
+        domain=[
+            ('code', '=', 'service.service'),
+            ['OR',
+                ('company', '=', Eval('company')),
+                ('company', '=', None),
+                ],
+            ],
+        context={
+            'code': 'service.service',
+            'company': Eval('company'),
+            },
+        depends=['company'],
+        help='Numbers the home services of the branch in every fiscal year, '
+        'it is never reset')
+
+    @classmethod
+    def __setup__(cls):
+        super(ServiceBranch, cls).__setup__()
+        cls._error_messages.update({
+                'different_service_sequence': 'Branch "%(first)s" and '
+                    '"%(second)s" have the same service sequence.',
+                'period_service_sequence': 'The service sequences of branch '
+                    '"%(branch)s" must differ from the ones of "%(period)s".',
+                'change_service_sequence': 'You can not change the service '
+                    'sequence of branch "%s" because it has already numbered '
+                    'services.',
+                })
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Service = pool.get('service.service')
+        Archive = pool.get('service.service.archive')
+        actions = iter(args)
+        for branches, values in zip(actions, actions):
+            for sequence_name in ('service_sequence', 'home_service_sequence'):
+                if sequence_name not in values:
+                    continue
+                for branch in branches:
+                    sequence = getattr(branch, sequence_name)
+                    if (sequence.id if sequence else None) == values[
+                            sequence_name]:
+                        continue
+                    domain = [
+                        ('branch', '=', branch.id),
+                        ('number_service', '!=', None),
+                        ('type', '=', sequence_name[:-9]),
+                        ]
+                    if (Service.search(domain, limit=1)
+                            or Archive.search(domain, limit=1)):
+                        cls.raise_user_error('change_service_sequence',
+                            (branch.rec_name,))
+        super(ServiceBranch, cls).write(*args)
+
+    @classmethod
+    def validate(cls, branches):
+        super(ServiceBranch, cls).validate(branches)
+        for branch in branches:
+            branch.check_service_sequences()
+
+    def check_service_sequences(self):
+        pool = Pool()
+        Period = pool.get('account.period')
+        FiscalYear = pool.get('account.fiscalyear')
+        for sequence_name in ('service_sequence', 'home_service_sequence'):
+            sequence = getattr(self, sequence_name)
+            if not sequence:
+                continue
+            # Sequences shared with periods or fiscal years would be drawn
+            # from in a different order by branch and non branch services
+            for Model in (Period, FiscalYear):
+                records = Model.search([
+                        ['OR',
+                            ('service_sequence', '=', sequence.id),
+                            ('home_service_sequence', '=', sequence.id),
+                            ],
+                        ], limit=1)
+                if records:
+                    self.raise_user_error('period_service_sequence', {
+                            'branch': self.rec_name,
+                            'period': records[0].rec_name,
+                            })
+            branches = self.search([
+                    ('id', '!=', self.id),
+                    ['OR',
+                        ('service_sequence', '=', sequence.id),
+                        ('home_service_sequence', '=', sequence.id),
+                        ],
+                    ])
+            if branches:
+                self.raise_user_error('different_service_sequence', {
+                        'first': self.rec_name,
+                        'second': branches[0].rec_name,
+                        })
+
+
+class User:
+    __name__ = 'res.user'
+    service_branch = fields.Many2One('service.branch', 'Service Branch',
+        domain=[
+            ('company', '=', Eval('company')),
+            ],
+        depends=['company'])
+
+    @classmethod
+    def __setup__(cls):
+        super(User, cls).__setup__()
+        if 'service_branch' not in cls._preferences_fields:
+            cls._preferences_fields.append('service_branch')
+        if 'service_branch' not in cls._context_fields:
+            cls._context_fields.append('service_branch')
@@ -0,0 +1,122 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+from trytond.pool import PoolMeta, Pool
+from trytond.transaction import Transaction
+from trytond.cache import Cache
+
+__all__ = ['NameCatalogMixin', 'ProductBrand', 'Template', 'Product',
+    'Employee', 'Translation']
+__metaclass__ = PoolMeta
+
+
+class NameCatalogMixin:
+    '''
+    Keep an in-process map from id to name of a small catalog.
+    The map is dropped on create, write and delete; the reset is stored in
+    the database by Cache so the other processes drop it too.
+    '''
+    _name_catalog = None
+
+    @classmethod
+    def get_name_catalog(cls):
+        key = cls._name_catalog_key()
+        names = cls._name_catalog.get(key)
+        if names is None:
+            names = cls._load_name_catalog()
+            cls._name_catalog.set(key, names)
+        return names
+
+    @classmethod
+    def _name_catalog_key(cls):
+        return None
+
+    @classmethod
+    def _load_name_catalog(cls):
+        with Transaction().set_user(0), \
+                Transaction().set_context(active_test=False):
+            return dict((r.id, r.rec_name) for r in cls.search([]))
+
+    @classmethod
+    def clear_name_catalog(cls):
+        cls._name_catalog.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(NameCatalogMixin, cls).create(vlist)
+        cls.clear_name_catalog()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(NameCatalogMixin, cls).write(*args)
+        cls.clear_name_catalog()
+
+    @classmethod
+    def delete(cls, records):
+        super(NameCatalogMixin, cls).delete(records)
+        cls.clear_name_catalog()
+
+
+class ProductBrand(NameCatalogMixin):
+    __name__ = 'product.brand'
+    _name_catalog = Cache('product.brand.name_catalog', context=False)
+
+
+class Template:
+    __name__ = 'product.template'
+
+    @classmethod
+    def write(cls, *args):
+        Product = Pool().get('product.product')
+        super(Template, cls).write(*args)
+        if any('name' in v for v in args[1::2]):
+            Product.clear_name_catalog()
+
+
+class Product(NameCatalogMixin):
+    __name__ = 'product.product'
+    _name_catalog = Cache('product.product.name_catalog', context=False)
+
+    @classmethod
+    def _load_name_catalog(cls):
+        # The template name without the code, as the reports print it
+        with Transaction().set_user(0), \
+                Transaction().set_context(active_test=False):
+            return dict((p.id, p.name) for p in cls.search([]))
+
+
+class Employee(NameCatalogMixin):
+    __name__ = 'company.employee'
+    _name_catalog = Cache('company.employee.name_catalog', context=False)
+
+
+class Translation:
+    __name__ = 'ir.translation'
+
+    @classmethod
+    def _clear_name_catalogs(cls, translations):
+        pool = Pool()
+        for model in set(t.name.split(',', 1)[0] for t in translations
+                if t.type == 'model' and t.name):
+            try:
+                Model = pool.get(model)
+            except KeyError:
+                continue
+            if hasattr(Model, 'clear_name_catalog'):
+                Model.clear_name_catalog()
+
+    @classmethod
+    def create(cls, vlist):
+        translations = super(Translation, cls).create(vlist)
+        cls._clear_name_catalogs(translations)
+        return translations
+
+    @classmethod
+    def write(cls, *args):
+        super(Translation, cls).write(*args)
+        cls._clear_name_catalogs(sum(args[0::2], []))
+
+    @classmethod
+    def delete(cls, translations):
+        cls._clear_name_catalogs(translations)
+        super(Translation, cls).delete(translations)
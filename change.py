@@ -0,0 +1,122 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+import datetime
+from sql.functions import Function
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.transaction import Transaction
+from trytond.rpc import RPC
+from trytond.config import config
+from trytond import backend
+
+__all__ = ['ServiceChange']
+
+_ACTIONS = [
+    ('create', 'Create'),
+    ('write', 'Write'),
+    ('delete', 'Delete'),
+    ('transition', 'Transition'),
+    ]
+
+
+class TxidCurrent(Function):
+    __slots__ = ()
+    _function = 'TXID_CURRENT'
+
+
+class ServiceChange(ModelSQL, ModelView):
+    'Service Change'
+    __name__ = 'service.service.change'
+    model = fields.Char('Model', required=True, readonly=True, select=True)
+    record = fields.Integer('Record', required=True, readonly=True)
+    service = fields.Integer('Service', readonly=True, select=True)
+    action = fields.Selection(_ACTIONS, 'Action', required=True,
+        readonly=True)
+    state = fields.Char('State', readonly=True)
+    txid = fields.BigInteger('Transaction', readonly=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ServiceChange, cls).__setup__()
+        cls._order.insert(0, ('id', 'ASC'))
+        cls.__rpc__['get_changes'] = RPC()
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        super(ServiceChange, cls).__register__(module_name)
+        # The changes logged before the transaction ids come first
+        cursor.execute(*table.update(
+                columns=[table.txid],
+                values=[0],
+                where=table.txid == None))
+
+    @classmethod
+    def log(cls, model, changes, action, state=None):
+        '''
+        Append a change per (record id, service id) pair.
+        The rows are inserted with a single statement and without going
+        through create to keep the cost on the writer side low.
+        '''
+        if not changes:
+            return
+        transaction = Transaction()
+        cursor = transaction.cursor
+        table = cls.__table__()
+        now = datetime.datetime.now()
+        txid = TxidCurrent() if backend.name() == 'postgresql' else 0
+        cursor.execute(*table.insert(
+                [table.model, table.record, table.service, table.action,
+                    table.state, table.txid, table.create_uid,
+                    table.create_date],
+                [[model, record, service, action, state, txid,
+                        transaction.user, now] for record, service in changes]))
+
+    @classmethod
+    def get_changes(cls, last_id=0, limit=None, last_txid=0):
+        '''
+        Return the changes after the last change read, given by its id and
+        txid, in transaction order.
+        On PostgreSQL the changes are ordered by transaction id and only the
+        transactions older than any running one are served, so a change
+        committed late can not fall behind the position of the consumer.
+        Other backends order by id and hold back the changes younger than
+        the grace delay; a transaction committing after it may be missed.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        batch = config.getint('nodux_technical_service',
+            'change_feed_batch', default=500)
+        limit = min(limit or batch, batch)
+        last_id, last_txid = last_id or 0, last_txid or 0
+
+        if backend.name() == 'postgresql':
+            cursor.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+            xmin, = cursor.fetchone()
+            where = (((table.txid > last_txid)
+                    | ((table.txid == last_txid) & (table.id > last_id)))
+                & (table.txid < xmin))
+        else:
+            grace = config.getint('nodux_technical_service',
+                'change_feed_grace', default=60)
+            until = (datetime.datetime.now()
+                - datetime.timedelta(seconds=grace))
+            where = (table.id > last_id) & (table.create_date <= until)
+        cursor.execute(*table.select(table.id, table.model, table.record,
+                table.service, table.action, table.state, table.create_date,
+                table.txid, where=where,
+                order_by=[table.txid.asc, table.id.asc], limit=limit))
+        changes = []
+        for id_, model, record, service, action, state, date, txid in (
+                cursor.fetchall()):
+            changes.append({
+                    'id': id_,
+                    'model': model,
+                    'record': record,
+                    'service': service,
+                    'action': action,
+                    'state': state,
+                    'date': date,
+                    'txid': txid,
+                    })
+        return changes
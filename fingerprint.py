@@ -0,0 +1,48 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+import re
+from collections import defaultdict
+from trytond.transaction import Transaction
+
+__all__ = ['device_fingerprint', 'backfill_fingerprint']
+
+_SEPARATORS = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def _normalize(value):
+    return _SEPARATORS.sub('', unicode(value or '').upper())
+
+
+def device_fingerprint(trademark, model, series):
+    '''
+    Return the key identifying the device of a service line or None when the
+    series is missing as the device can not be told apart from others.
+    '''
+    trademark = getattr(trademark, 'id', trademark)
+    if not trademark or (series or '').strip().upper() in ('', 'S/S'):
+        return None
+    series = _normalize(series)
+    if not series:
+        return None
+    return u'%s:%s:%s' % (trademark, _normalize(model), series)
+
+
+def backfill_fingerprint(cls):
+    'Fill the fingerprint of the rows of cls stored before it existed'
+    cursor = Transaction().cursor
+    table = cls.__table__()
+    cursor.execute(*table.select(table.id, table.trademark, table.model,
+            table.series,
+            where=(table.fingerprint == None) & (table.series != None)))
+    ids = defaultdict(list)
+    for line_id, trademark, model, series in cursor.fetchall():
+        fingerprint = device_fingerprint(trademark, model, series)
+        if fingerprint:
+            ids[fingerprint].append(line_id)
+    for fingerprint, line_ids in ids.iteritems():
+        for i in range(0, len(line_ids), cursor.IN_MAX):
+            sub_ids = line_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.update(
+                    columns=[table.fingerprint],
+                    values=[fingerprint],
+                    where=table.id.in_(sub_ids)))
@@ -0,0 +1,43 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+from trytond.transaction import Transaction
+from trytond import backend
+
+__all__ = ['FTS_CONFIG', 'FTS_FIELDS', 'fts_text', 'fts_document',
+    'register_fts_index']
+
+# Text search configuration and columns covered by the full-text indexes
+FTS_CONFIG = 'spanish'
+FTS_FIELDS = {
+    'service.service': ['observations', 'detail', 'accessories'],
+    'service.service.line': ['failure'],
+    'service.service.history_lines': ['description'],
+    'service.service.archive': ['observations', 'detail', 'accessories'],
+    'service.service.line.archive': ['failure'],
+    'service.service.history_lines.archive': ['description'],
+}
+
+
+def fts_text(columns):
+    return " || ' ' || ".join('COALESCE("%s", \'\')' % c for c in columns)
+
+
+def fts_document(columns):
+    return "to_tsvector('%s', %s)" % (FTS_CONFIG, fts_text(columns))
+
+
+def register_fts_index(model, table=None):
+    '''
+    Create the full-text index of model on table, by default the table of
+    model, if the backend supports it
+    '''
+    if backend.name() != 'postgresql':
+        return
+    cursor = Transaction().cursor
+    table = table or model._table
+    index = '%s_fts_index' % table
+    cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s', (index,))
+    if cursor.fetchone():
+        return
+    cursor.execute('CREATE INDEX "%s" ON "%s" USING gin (%s)' % (
+            index, table, fts_document(FTS_FIELDS[model.__name__])))
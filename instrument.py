@@ -0,0 +1,140 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+import datetime
+import functools
+import logging
+import time
+from collections import deque
+
+from trytond.transaction import Transaction
+from trytond.config import config
+
+__all__ = ['QueryCounter', 'instrumented', 'get_statistics']
+
+logger = logging.getLogger(__name__)
+
+# Last measures of the process, read by get_statistics
+_MEASURES = deque(maxlen=1000)
+
+
+class QueryCounter(object):
+    'Count the queries, SQL time and fetched rows of the transaction cursor'
+
+    _methods = ('execute', 'fetchone', 'fetchmany', 'fetchall')
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.sql_time = 0.
+
+    def __enter__(self):
+        cursor = Transaction().cursor
+        self._cursor = cursor
+        # Keep the wrappers of an enclosing counter to restore them
+        self._previous = dict((n, cursor.__dict__[n]) for n in self._methods
+            if n in cursor.__dict__)
+        execute = cursor.execute
+        fetchone = cursor.fetchone
+        fetchmany = cursor.fetchmany
+        fetchall = cursor.fetchall
+
+        def count_execute(*args, **kwargs):
+            self.queries += 1
+            start = time.time()
+            try:
+                return execute(*args, **kwargs)
+            finally:
+                self.sql_time += time.time() - start
+
+        def count_fetchone():
+            row = fetchone()
+            if row is not None:
+                self.rows += 1
+            return row
+
+        def count_fetchmany(*args, **kwargs):
+            rows = fetchmany(*args, **kwargs)
+            self.rows += len(rows)
+            return rows
+
+        def count_fetchall():
+            rows = fetchall()
+            self.rows += len(rows)
+            return rows
+
+        cursor.execute = count_execute
+        cursor.fetchone = count_fetchone
+        cursor.fetchmany = count_fetchmany
+        cursor.fetchall = count_fetchall
+        return self
+
+    def __exit__(self, type, value, traceback):
+        for name in self._methods:
+            if name in self._previous:
+                setattr(self._cursor, name, self._previous[name])
+            else:
+                del self._cursor.__dict__[name]
+
+
+def enabled():
+    'Instrumentation is enabled by context or by configuration'
+    if 'service_instrument' in Transaction().context:
+        return bool(Transaction().context['service_instrument'])
+    return config.getboolean('nodux_technical_service', 'instrument',
+        default=False)
+
+
+def instrumented(name):
+    '''
+    Decorate an entry point to measure it when instrumentation is enabled.
+    Each call is logged and kept for get_statistics.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            start = time.time()
+            with QueryCounter() as counter:
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    wall = time.time() - start
+                    measure = {
+                        'name': name,
+                        'date': datetime.datetime.now(),
+                        'user': Transaction().user,
+                        'queries': counter.queries,
+                        'rows': counter.rows,
+                        'sql_ms': counter.sql_time * 1000,
+                        'python_ms': (wall - counter.sql_time) * 1000,
+                        }
+                    _MEASURES.append(measure)
+                    logger.info('%(name)s queries=%(queries)s rows=%(rows)s '
+                        'sql_ms=%(sql_ms).1f python_ms=%(python_ms).1f '
+                        'user=%(user)s', measure)
+        return wrapper
+    return decorator
+
+
+def get_statistics(name=None):
+    'Return the measures of the process aggregated by entry point'
+    statistics = {}
+    for measure in list(_MEASURES):
+        if name and measure['name'] != name:
+            continue
+        stats = statistics.setdefault(measure['name'], {
+                'calls': 0,
+                'queries': 0,
+                'max_queries': 0,
+                'rows': 0,
+                'sql_ms': 0.,
+                'python_ms': 0.,
+                })
+        stats['calls'] += 1
+        stats['queries'] += measure['queries']
+        stats['max_queries'] = max(stats['max_queries'], measure['queries'])
+        stats['rows'] += measure['rows']
+        stats['sql_ms'] += measure['sql_ms']
+        stats['python_ms'] += measure['python_ms']
+    return statistics
@@ -0,0 +1,193 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+import datetime
+import logging
+import traceback
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from trytond.config import config
+
+__all__ = ['ServiceJob']
+
+logger = logging.getLogger(__name__)
+
+_STATES = [
+    ('pending', 'Pending'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+    ]
+
+
+class ServiceJob(ModelSQL, ModelView):
+    'Service Job'
+    __name__ = 'service.job'
+    model = fields.Char('Model', required=True, readonly=True)
+    record = fields.Integer('Record', required=True, readonly=True)
+    method = fields.Char('Method', required=True, readonly=True)
+    user = fields.Many2One('res.user', 'User', readonly=True,
+        help='The user who queued the job and as whom it runs')
+    state = fields.Selection(_STATES, 'State', required=True, readonly=True,
+        select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    next_attempt = fields.DateTime('Next Attempt', readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ServiceJob, cls).__setup__()
+        cls._order.insert(0, ('id', 'ASC'))
+        cls._buttons.update({
+                'retry': {
+                    'invisible': Eval('state') != 'failed',
+                    },
+                })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def enqueue(cls, records, method):
+        '''
+        Queue a call of method for each record.
+        The jobs are created in the current transaction so they are only
+        run if it is committed.
+        '''
+        if not records:
+            return []
+        user = Transaction().user
+        with Transaction().set_user(0):
+            return cls.create([{
+                        'model': r.__name__,
+                        'record': r.id,
+                        'method': method,
+                        'user': user,
+                        } for r in records])
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, jobs):
+        cls.write(jobs, {
+                'state': 'pending',
+                'attempts': 0,
+                'next_attempt': None,
+                'error': None,
+                })
+
+    @classmethod
+    def run_pending(cls):
+        '''
+        Run the pending jobs, each one in its own transaction.
+        This is meant to be called by the cron of each worker process.
+        '''
+        cursor = Transaction().cursor
+        batch = config.getint('nodux_technical_service', 'job_batch',
+            default=100)
+        now = datetime.datetime.now()
+
+        cls._reset_stalled()
+        cls._purge_done()
+        cursor.commit()
+
+        jobs = cls.search([
+                ('state', '=', 'pending'),
+                ['OR',
+                    ('next_attempt', '=', None),
+                    ('next_attempt', '<=', now),
+                    ],
+                ], limit=batch)
+        job_ids = [j.id for j in jobs]
+        for job_id in job_ids:
+            if not cls._claim(job_id):
+                continue
+            cursor.commit()
+            job = cls(job_id)
+            try:
+                job.run()
+            except Exception, exception:
+                cursor.rollback()
+                Transaction().cache.clear()
+                cls(job_id).fail(exception)
+            else:
+                cls.write([job], {
+                        'state': 'done',
+                        'error': None,
+                        })
+            cursor.commit()
+
+    @classmethod
+    def _claim(cls, job_id):
+        'Mark the job as running unless another worker took it first'
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        cursor.execute(*table.update(
+                columns=[table.state, table.write_date],
+                values=['running', datetime.datetime.now()],
+                where=(table.id == job_id) & (table.state == 'pending')))
+        return cursor.rowcount == 1
+
+    @classmethod
+    def _reset_stalled(cls):
+        'Put back in the queue the jobs of a worker that died'
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        timeout = config.getint('nodux_technical_service', 'job_timeout',
+            default=3600)
+        limit = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+        cursor.execute(*table.update(
+                columns=[table.state],
+                values=['pending'],
+                where=(table.state == 'running')
+                & (table.write_date < limit)))
+
+    @classmethod
+    def _purge_done(cls):
+        'Delete the jobs done for longer than the retention'
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        days = config.getint('nodux_technical_service', 'job_retention',
+            default=7)
+        limit = datetime.datetime.now() - datetime.timedelta(days=days)
+        cursor.execute(*table.delete(
+                where=(table.state == 'done')
+                & (table.write_date < limit)))
+
+    def run(self):
+        pool = Pool()
+        User = pool.get('res.user')
+        Model = pool.get(self.model)
+        user_id = self.user.id if self.user else 0
+        with Transaction().set_user(user_id):
+            context = User.get_preferences(context_only=True)
+        with Transaction().set_user(user_id), \
+                Transaction().set_context(context):
+            records = Model.browse([self.record])
+            getattr(Model, self.method)(records)
+
+    def fail(self, exception):
+        'Schedule a new attempt with exponential backoff or give up'
+        max_attempts = config.getint('nodux_technical_service',
+            'job_max_attempts', default=5)
+        backoff = config.getint('nodux_technical_service', 'job_backoff',
+            default=60)
+        attempts = (self.attempts or 0) + 1
+        logger.warning('Job %s %s(%s) failed (attempt %s)', self.id,
+            self.method, self.record, attempts, exc_info=True)
+        values = {
+            'attempts': attempts,
+            'error': traceback.format_exc(),
+            }
+        if attempts >= max_attempts:
+            values['state'] = 'failed'
+        else:
+            values['state'] = 'pending'
+            values['next_attempt'] = (datetime.datetime.now()
+                + datetime.timedelta(seconds=backoff * 2 ** (attempts - 1)))
+        self.write([self], values)
@@ -39,6 +39,13 @@ class Party:
         if parties:
             return [('vat_number',) + tuple(clause[1:])]
         return [('name',) + tuple(clause[1:])]
+
+    @classmethod
+    def write(cls, *args):
+        Employee = Pool().get('company.employee')
+        super(Party, cls).write(*args)
+        if any('name' in v for v in args[1::2]):
+            Employee.clear_name_catalog()
         
 class Company:
     __name__ = 'company.company'
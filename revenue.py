@@ -0,0 +1,217 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+import datetime
+from collections import defaultdict
+from decimal import Decimal
+from sql.aggregate import Count, Sum
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.config import config
+from trytond import backend
+
+__all__ = ['ServiceRevenueDirty', 'ServiceRevenueRollup', 'GROUPING']
+
+# Grouping accepted by the revenue aggregation
+GROUPING = ('year', 'month', 'type', 'product', 'periferic', 'trademark')
+
+
+def _month(date):
+    if isinstance(date, basestring):
+        date = datetime.date(*map(int, date[:10].split('-')))
+    return date.replace(day=1)
+
+
+def _next_month(month):
+    return (month + datetime.timedelta(days=32)).replace(day=1)
+
+
+def _group_keys(grouping, date_column):
+    'Return the columns to group by for grouping without duplicates'
+    keys = []
+    for name in grouping:
+        key = date_column if name in ('year', 'month') else name
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+def _fold(rows, grouping, keys, date_column):
+    '''
+    Sum the (amount, quantity) of rows grouped by keys into the values of
+    grouping, truncating the dates to the year or month.
+    '''
+    result = defaultdict(lambda: [Decimal(0), 0])
+    for row in rows:
+        values = dict(zip(keys, row[:-2]))
+        key = []
+        for name in grouping:
+            if name == 'year':
+                key.append(_month(values[date_column]).year)
+            elif name == 'month':
+                key.append(_month(values[date_column]))
+            else:
+                key.append(values[name])
+        amount, quantity = row[-2:]
+        if amount is not None and not isinstance(amount, Decimal):
+            amount = Decimal(str(amount))
+        result[tuple(key)][0] += amount or Decimal(0)
+        result[tuple(key)][1] += int(quantity or 0)
+    return dict((k, tuple(v)) for k, v in result.iteritems())
+
+
+class ServiceRevenueDirty(ModelSQL):
+    'Service Revenue Dirty'
+    __name__ = 'service.revenue.dirty'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        select=True)
+    month = fields.Date('Month', required=True, select=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        exist = TableHandler.table_exist(cursor, cls._table)
+
+        super(ServiceRevenueDirty, cls).__register__(module_name)
+
+        if not exist:
+            cls._invalidate_all()
+
+    @classmethod
+    def _invalidate_all(cls):
+        'Mark all the months with services to be rolled up'
+        pool = Pool()
+        cursor = Transaction().cursor
+        for name in ('service.service', 'service.service.archive'):
+            service = pool.get(name).__table__()
+            cursor.execute(*service.select(service.company,
+                    service.entry_date,
+                    where=service.entry_date != None,
+                    group_by=[service.company, service.entry_date]))
+            cls.invalidate(cursor.fetchall())
+
+    @classmethod
+    def invalidate(cls, keys):
+        '''
+        Mark the (company id, date) keys to be refreshed in the rollup.
+        Only rows are inserted so concurrent transactions do not lock each
+        other; refresh deletes them.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        months = set((c, _month(d)) for c, d in keys if c and d)
+        if not months:
+            return
+        now = datetime.datetime.now()
+        user = Transaction().user
+        cursor.execute(*table.insert(
+                [table.company, table.month, table.create_uid,
+                    table.create_date],
+                [[c, m, user, now] for c, m in months]))
+
+
+class ServiceRevenueRollup(ModelSQL):
+    'Service Revenue Rollup'
+    __name__ = 'service.revenue.rollup'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        select=True)
+    month = fields.Date('Month', required=True, select=True)
+    type = fields.Char('Type')
+    product = fields.Many2One('product.product', 'Product')
+    periferic = fields.Many2One('service.periferic', 'Periferic')
+    trademark = fields.Many2One('product.brand', 'Trademark')
+    amount = fields.Numeric('Amount')
+    quantity = fields.Integer('Quantity')
+
+    @classmethod
+    def refresh(cls):
+        'Recompute the rollup of the months changed since the last refresh'
+        pool = Pool()
+        Dirty = pool.get('service.revenue.dirty')
+        cursor = Transaction().cursor
+        dirty = Dirty.__table__()
+
+        # Only the dirty rows read here are deleted: their changes were
+        # committed before the lines are aggregated
+        cursor.execute(*dirty.select(dirty.id, dirty.company, dirty.month))
+        dirty_ids = defaultdict(list)
+        for dirty_id, company, month in cursor.fetchall():
+            dirty_ids[(company, _month(month))].append(dirty_id)
+
+        dims = ['type', 'product', 'periferic', 'trademark']
+        for (company, start), ids in sorted(dirty_ids.iteritems()):
+            end = _next_month(start) - datetime.timedelta(days=1)
+            rows = cls.aggregate_lines(company, start, end, dims)
+            cls.delete(cls.search([
+                        ('company', '=', company),
+                        ('month', '=', start),
+                        ]))
+            cls.create([dict(zip(dims, key), company=company,
+                        month=start, amount=amount, quantity=quantity)
+                    for key, (amount, quantity) in rows.iteritems()])
+            for i in range(0, len(ids), cursor.IN_MAX):
+                cursor.execute(*dirty.delete(
+                        where=dirty.id.in_(ids[i:i + cursor.IN_MAX])))
+            cursor.commit()
+
+    @classmethod
+    def aggregate_lines(cls, company, start, end, grouping):
+        '''
+        Sum the reference amount and count the lines of the services of
+        company entered between start and end, grouped by grouping.
+        Return a dictionary from the grouping values to (amount, quantity).
+        '''
+        pool = Pool()
+        cursor = Transaction().cursor
+        keys = _group_keys(grouping, 'entry_date')
+        rows = []
+        for service_name, line_name in (
+                ('service.service', 'service.service.line'),
+                ('service.service.archive', 'service.service.line.archive')):
+            service = pool.get(service_name).__table__()
+            line = pool.get(line_name).__table__()
+            columns = [getattr(service if k in ('entry_date', 'type')
+                    else line, k) for k in keys]
+            cursor.execute(*line.join(service,
+                    condition=line.service == service.id
+                    ).select(*(columns + [Sum(line.reference_amount),
+                            Count(line.id)]),
+                    where=(service.company == company)
+                    & (service.entry_date >= start)
+                    & (service.entry_date <= end),
+                    group_by=columns))
+            rows.extend(cursor.fetchall())
+        return _fold(rows, grouping, keys, 'entry_date')
+
+    @classmethod
+    def aggregate(cls, company, start, end, grouping):
+        '''
+        Same as aggregate_lines but read from the rollup when the range
+        covers whole months and none of them is dirty. The log of dirty
+        months covers every change, so a month without dirty entries is up
+        to date, also when it has no service.
+        '''
+        Dirty = Pool().get('service.revenue.dirty')
+        if not (config.getboolean('nodux_technical_service',
+                    'revenue_rollup', default=True)
+                and start.day == 1
+                and (end + datetime.timedelta(days=1)).day == 1):
+            return cls.aggregate_lines(company, start, end, grouping)
+        if Dirty.search([
+                    ('company', '=', company),
+                    ('month', '>=', start),
+                    ('month', '<=', end),
+                    ], limit=1):
+            return cls.aggregate_lines(company, start, end, grouping)
+
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        keys = _group_keys(grouping, 'month')
+        columns = [getattr(table, k) for k in keys]
+        cursor.execute(*table.select(*(columns + [Sum(table.amount),
+                        Sum(table.quantity)]),
+                where=(table.company == company)
+                & (table.month >= start) & (table.month <= end),
+                group_by=columns))
+        return _fold(cursor.fetchall(), grouping, keys, 'month')
@@ -5,7 +5,7 @@
 # the full copyright notices and license terms.
 from decimal import Decimal
 import datetime
-from trytond.model import ModelSQL, Workflow, fields, ModelView
+from trytond.model import Model, ModelSQL, Workflow, fields, ModelView
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
 from trytond.pyson import Bool, Eval, Or, If
@@ -20,6 +20,7 @@ import re
 from xml.dom.minidom import parse, parseString
 import time
 from trytond.rpc import RPC
+from trytond.cache import Cache
 import os
 from trytond import backend
 from trytond import security
@@ -30,6 +31,16 @@ except ImportError:
 import random
 import hashlib
 import string
+from .catalog import NameCatalogMixin
+from .instrument import instrumented, get_statistics
+from .archive import search_archive
+from .revenue import GROUPING
+from .fingerprint import device_fingerprint, backfill_fingerprint
+from .fts import FTS_CONFIG, FTS_FIELDS, fts_text, fts_document, \
+    register_fts_index
+from contextlib import contextmanager
+from collections import defaultdict
+from trytond.config import config
 #from datetime import timedelta
 
 _ZERO = Decimal('0.0')
@@ -39,18 +50,48 @@ _TYPE = [
     ('home_service', 'Servicio a domicilio')
 ]
 
-__all__ = ['Periferic', 'Service', 'ServiceLine', 'HistoryLine',
-            'ServiceReport', 'DraftServiceStart', 'DraftService']
+__all__ = ['Periferic', 'ServicePhoto', 'Service', 'ServiceLine',
+            'HistoryLine', 'ServiceReport', 'DraftServiceStart',
+            'DraftService']
 
 _STATES = {
     'readonly': Eval('state') == 'delivered',
 }
 _DEPENDS = ['state']
 
-class Periferic(ModelSQL, ModelView):
+
+@contextmanager
+def savepoint(name='service_savepoint'):
+    'Roll back to a savepoint the changes of the block if it fails'
+    transaction = Transaction()
+    cursor = transaction.cursor
+    cursor.execute('SAVEPOINT "%s"' % name)
+    try:
+        yield
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % name)
+        transaction.cache.clear()
+        raise
+    else:
+        cursor.execute('RELEASE SAVEPOINT "%s"' % name)
+
+
+class Periferic(NameCatalogMixin, ModelSQL, ModelView):
     'Periferic'
     __name__ = 'service.periferic'
     name = fields.Char('Periferic', size=None, required=True, translate=True)
+    _name_catalog = Cache('service.periferic.name_catalog', context=False)
+
+    @classmethod
+    def _name_catalog_key(cls):
+        Config = Pool().get('ir.configuration')
+        return Transaction().context.get('language') or Config.get_language()
+
+    @classmethod
+    def _load_name_catalog(cls):
+        'Load the names translated in the language of the key'
+        with Transaction().set_context(language=cls._name_catalog_key()):
+            return super(Periferic, cls)._load_name_catalog()
 
     @classmethod
     def __setup__(cls):
@@ -69,6 +110,50 @@ class Periferic(ModelSQL, ModelView):
             table.drop_column('code')
 
 
+class ServicePhoto(ModelSQL):
+    '''
+    Service Photo
+
+    Kept apart from the service so its history does not copy the photo on
+    every change. The service is stored as an integer to keep the photo of
+    the archived services.
+    '''
+    __name__ = 'service.service.photo'
+    service = fields.Integer('Service', required=True, select=True)
+    photo = fields.Binary('Foto')
+
+    @classmethod
+    def __setup__(cls):
+        super(ServicePhoto, cls).__setup__()
+        cls._sql_constraints += [
+            ('service_uniq', 'UNIQUE(service)',
+                'A service can only have one photo.'),
+            ]
+
+    @classmethod
+    def get_photos(cls, ids):
+        'Return the photo by service id'
+        photos = dict((i, None) for i in ids)
+        for photo in cls.search([('service', 'in', list(ids))]):
+            photos[photo.service] = photo.photo
+        return photos
+
+    @classmethod
+    def set_photos(cls, ids, value):
+        cls.delete(cls.search([('service', 'in', list(ids))]))
+        if value:
+            cls.create([{'service': i, 'photo': value} for i in ids])
+
+    @classmethod
+    def move_column(cls, table):
+        'Move the photo column of table to the photos'
+        cursor = Transaction().cursor
+        cursor.execute('INSERT INTO "%s" '
+            '("service", "photo", "create_uid", "create_date") '
+            'SELECT "id", "photo", "create_uid", "create_date" FROM "%s" '
+            'WHERE "photo" IS NOT NULL' % (cls._table, table))
+
+
 class Service(Workflow, ModelSQL, ModelView):
     'Service'
     __name__ = 'service.service'
@@ -97,6 +182,14 @@ class Service(Workflow, ModelSQL, ModelView):
         domain=[('delivery_date', '>', Eval('entry_date', None))],
         depends=['entry_date'])
     technical = fields.Many2One('company.employee', 'Technical', states=_STATES)
+    branch = fields.Many2One('service.branch', 'Branch', select=True,
+        domain=[
+            ('company', '=', Eval('company')),
+            ],
+        states={
+            'readonly': Bool(Eval('number_service')),
+            },
+        depends=['company', 'number_service'])
     garanty = fields.Boolean('Garanty', help="Income Garanty", states=_STATES)
     new = fields.Boolean('New', states={
             'invisible': ~Eval('garanty', True),
@@ -142,7 +235,8 @@ class Service(Workflow, ModelSQL, ModelView):
             'invisible': ~Eval('garanty', True),
             'readonly': Eval('state') == 'delivered',
     })
-    photo = fields.Binary('Foto', states=_STATES)
+    photo = fields.Function(fields.Binary('Foto', states=_STATES),
+        'get_photo', setter='set_photo')
     state = fields.Selection([
             ('pending', 'Pending'),
             ('review', 'In Review'),
@@ -166,17 +260,40 @@ class Service(Workflow, ModelSQL, ModelView):
         'invisible': Eval('state') != 'delivered',
         'readonly': Eval('detail') != '',
     })
+    intake_reference = fields.Char('Intake Reference', readonly=True,
+        select=True, help='Reference of the draft submitted offline')
 
     @classmethod
     def __setup__(cls):
         super(Service, cls).__setup__()
 
         cls.__rpc__['getTechnicalService'] = RPC(check_access=False, readonly=False)
+        cls.__rpc__['search_text'] = RPC()
+        cls.__rpc__['get_instrumentation'] = RPC()
+        cls.__rpc__['batch_transition'] = RPC(readonly=False)
+        cls.__rpc__['get_intake_snapshot'] = RPC()
+        cls.__rpc__['submit_drafts'] = RPC(readonly=False)
 
         cls._error_messages.update({
                 'modify_invoice': ('You can not modify service "%s".'),
                 'delete_cancel': ('You can not delete service "%s".'),
+                'no_service_sequence': ('There is no service sequence '
+                    'defined for service "%(service)s" in period '
+                    '"%(period)s".'),
+                'invalid_transition': ('Service "%(service)s" can not go '
+                    'from state "%(from)s" to "%(to)s".'),
+                'unknown_transition': ('"%s" is not a service transition.'),
+                'missing_intake_reference': ('The draft has no intake '
+                    'reference.'),
+                'duplicate_intake_reference': ('The intake reference "%s" '
+                    'is used by another draft of the same submission.'),
+                'unknown_party': ('There is no party with VAT number '
+                    '"%s".'),
                 })
+        cls._sql_constraints += [
+            ('intake_reference_uniq', 'UNIQUE(intake_reference)',
+                'The intake reference must be unique.'),
+            ]
 
         cls._transitions |= set((
                 ('pending', 'review'),
@@ -206,6 +323,47 @@ class Service(Workflow, ModelSQL, ModelView):
                 },
             })
 
+        # Methods queued on service.job after each transition, by state.
+        # Modules extending service.service add their side effects here:
+        #     cls._transition_jobs.setdefault('delivered', []).append(
+        #         'send_delivery_notice')
+        cls._transition_jobs = {}
+
+        # Fields accepted from the services and lines drafted offline
+        cls._intake_fields = set(['intake_reference', 'party', 'type',
+                'entry_date', 'delivery_date', 'technical', 'branch',
+                'garanty', 'new', 'lined', 'beaten', 'broken', 'stained',
+                'invoice_date', 'invoice_number', 'case_number',
+                'accessories', 'observations', 'total_home_service'])
+        cls._intake_line_fields = set(['product', 'periferic', 'trademark',
+                'model', 'series', 'failure', 'reference_amount',
+                'technical'])
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+        photo_exist = table.column_exist('photo')
+
+        super(Service, cls).__register__(module_name)
+        register_fts_index(cls)
+
+        # Migration: photo moved to service.service.photo
+        if photo_exist:
+            Pool().get('service.service.photo').move_column(cls._table)
+            table.drop_column('photo')
+
+    @classmethod
+    def get_photo(cls, services, name):
+        Photo = Pool().get('service.service.photo')
+        return Photo.get_photos([s.id for s in services])
+
+    @classmethod
+    def set_photo(cls, services, name, value):
+        Photo = Pool().get('service.service.photo')
+        Photo.set_photos([s.id for s in services], value)
+
     @fields.depends('invoice_date', 'garanty')
     def on_change_invoice_date(self):
         res = {}
@@ -225,13 +383,28 @@ class Service(Workflow, ModelSQL, ModelView):
     def get_state_date(cls, services, names):
         pool = Pool()
         Date = pool.get('ir.date')
+        Calendar = pool.get('service.calendar')
         date_now = Date.today()
+        calendars = dict((c, Calendar.get_calendar(c))
+            for c in set(s.company.id for s in services))
         result = {n: {s.id: '' for s in services} for n in names}
         for name in names:
             for service in services:
-                if (service.delivery_date < date_now) and (service.state != 'delivered'):
+                calendar = calendars[service.company.id]
+                if (service.state == 'delivered'
+                        or not service.delivery_date):
+                    result[name][service.id] = ''
+                elif calendar:
+                    due_date = calendar.roll_forward(service.delivery_date)
+                    if calendar.business_days_overdue(due_date, date_now):
+                        result[name][service.id] = 'vencida'
+                    elif due_date == date_now:
+                        result[name][service.id] = 'vence_hoy'
+                    else:
+                        result[name][service.id] = ''
+                elif service.delivery_date < date_now:
                     result[name][service.id] = 'vencida'
-                elif (service.delivery_date == date_now) and (service.state != 'delivered'):
+                elif service.delivery_date == date_now:
                     result[name][service.id] = 'vence_hoy'
                 else:
                     result[name][service.id] = ''
@@ -250,9 +423,17 @@ class Service(Workflow, ModelSQL, ModelView):
     def default_detail():
         return ''
 
-    @staticmethod
-    def default_delivery_date():
-        Date = Pool().get('ir.date')
+    @classmethod
+    def default_delivery_date(cls):
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Calendar = pool.get('service.calendar')
+        calendar = Calendar.get_calendar(
+            Transaction().context.get('company'))
+        if calendar:
+            # The delivery date must be after the entry date
+            return calendar.add_business_days(Date.today(),
+                max(calendar.get_sla_days(cls.default_type()), 1))
         return Date.today()+ datetime.timedelta(days=1)
 
     @staticmethod
@@ -267,6 +448,10 @@ class Service(Workflow, ModelSQL, ModelView):
     def default_company():
         return Transaction().context.get('company')
 
+    @staticmethod
+    def default_branch():
+        return Transaction().context.get('service_branch')
+
     @classmethod
     def get_amount(cls, services, names):
         amount = Decimal(0.0)
@@ -297,26 +482,37 @@ class Service(Workflow, ModelSQL, ModelView):
         return res
 
     def set_number(self):
-        pool = Pool()
-        Period = pool.get('account.period')
-        Sequence = pool.get('ir.sequence.strict')
-        Date = pool.get('ir.date')
-
-        if self.number_service:
-            return
+        vals = self.get_number_values()
+        if vals:
+            self.write([self], vals)
 
+    def get_number_sequence(self):
+        'Return the strict sequence that numbers the service'
+        Period = Pool().get('account.period')
         test_state = True
 
         accounting_date = self.entry_date
         period_id = Period.find(self.company.id,
             date=accounting_date, test_state=test_state)
         period = Period(period_id)
-        sequence = period.get_service_sequence(self.type)
+        sequence = period.get_service_sequence(self.type, self.branch)
         if not sequence:
-            self.raise_user_error('no_withholding_sequence', {
-                    'withholding': self.rec_name,
+            self.raise_user_error('no_service_sequence', {
+                    'service': self.rec_name,
                     'period': period.rec_name,
                     })
+        return sequence
+
+    def get_number_values(self, sequence=None):
+        'Return the values that number the service'
+        pool = Pool()
+        Sequence = pool.get('ir.sequence.strict')
+        Date = pool.get('ir.date')
+
+        if self.number_service:
+            return {}
+        if sequence is None:
+            sequence = self.get_number_sequence()
         with Transaction().set_context(
                 date=self.entry_date or Date.today()):
             number = Sequence.get_id(sequence.id)
@@ -324,7 +520,7 @@ class Service(Workflow, ModelSQL, ModelView):
             if (not self.entry_date
                     and self.type in ('service')):
                 vals['entry_date'] = Transaction().context['date']
-        self.write([self], vals)
+        return vals
 
     @classmethod
     def check_modify(cls, services):
@@ -332,63 +528,602 @@ class Service(Workflow, ModelSQL, ModelView):
             if (service.state in ('delivered')):
                 cls.raise_user_error('modify_invoice', (service.number_service,))
 
+    @classmethod
+    def search(cls, domain, offset=0, limit=None, order=None, count=False,
+            query=False):
+        '''
+        Include the archived services when the domain asks for delivered
+        services or old entry dates. Both sets are merged following order
+        before the offset and limit are applied.
+        '''
+        if query or not search_archive(domain):
+            return super(Service, cls).search(domain, offset=offset,
+                limit=limit, order=order, count=count, query=query)
+        Archive = Pool().get('service.service.archive')
+        end = offset + limit if limit is not None else None
+        order = order or cls._order
+        result = super(Service, cls).search(domain, limit=end, order=order,
+            count=count)
+        archived = Archive.search(domain, limit=end,
+            order=[o for o in order if o[0] in Archive._fields],
+            count=count)
+        if count:
+            return result + archived
+        records = cls._sort_records(list(result) + list(archived), order)
+        return cls.browse([r.id for r in records][offset:end])
+
+    @staticmethod
+    def _sort_records(records, order):
+        '''
+        Sort in place records of the hot and archive tables like the
+        database does for order: many2one by record name, nulls last in
+        ascending order.
+        '''
+        def value(record, name):
+            value = getattr(record, name, None)
+            if isinstance(value, Model):
+                value = value.rec_name
+            return (value is None, value)
+        for name, direction in reversed(order):
+            records.sort(key=lambda r: value(r, name),
+                reverse=(direction or '').upper().startswith('DESC'))
+        return records
+
+    @classmethod
+    def read(cls, ids, fields_names=None):
+        Archive = Pool().get('service.service.archive')
+        return Archive.read_with_archive(cls, ids, fields_names,
+            super(Service, cls).read)
+
+    @classmethod
+    def copy(cls, services, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.setdefault('intake_reference', None)
+        new_services = super(Service, cls).copy(services, default=default)
+        if 'photo' not in default:
+            Photo = Pool().get('service.service.photo')
+            photos = Photo.get_photos([s.id for s in services])
+            Photo.create([{'service': new.id, 'photo': photos[old.id]}
+                    for old, new in zip(services, new_services)
+                    if photos[old.id]])
+        return new_services
+
+    @classmethod
+    def create(cls, vlist):
+        Change = Pool().get('service.service.change')
+        services = super(Service, cls).create(vlist)
+        Change.log(cls.__name__, [(s.id, s.id) for s in services], 'create')
+        return services
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Change = pool.get('service.service.change')
+        RevenueDirty = pool.get('service.revenue.dirty')
+        # Skip the services left unchanged to not store a history snapshot
+        actions = iter(args)
+        args = []
+        for services, values in zip(actions, actions):
+            services = [s for s in services if s._has_changes(values)]
+            if services:
+                args.extend((services, values))
+        if not args:
+            return
+        revenue_keys = cls._revenue_keys(args)
+        super(Service, cls).write(*args)
+        revenue_keys |= cls._revenue_keys(args, reload=True)
+        RevenueDirty.invalidate(revenue_keys)
+        actions = iter(args)
+        for services, values in zip(actions, actions):
+            changes = [(s.id, s.id) for s in services]
+            if 'state' in values:
+                Change.log(cls.__name__, changes, 'transition',
+                    state=values['state'])
+            else:
+                Change.log(cls.__name__, changes, 'write')
+
+    @classmethod
+    def _revenue_keys(cls, args, reload=False):
+        'Return the revenue months of the services written with args'
+        keys = set()
+        actions = iter(args)
+        for services, values in zip(actions, actions):
+            if not set(values) & set(['entry_date', 'company', 'type']):
+                continue
+            if reload:
+                services = cls.browse([s.id for s in services])
+            keys.update((s.company.id, s.entry_date) for s in services)
+        return keys
+
+    def _has_changes(self, values):
+        'Test if writing values would change the service'
+        for name, value in values.iteritems():
+            field = self._fields.get(name)
+            if (field is None
+                    or field._type in ('one2many', 'many2many')):
+                return True
+            current = getattr(self, name)
+            if field._type == 'many2one':
+                current = current.id if current else None
+            elif field._type == 'binary':
+                current = str(current) if current is not None else None
+                value = str(value) if value is not None else None
+            if current != value:
+                return True
+        return False
+
+    @classmethod
+    def compact_history(cls):
+        '''
+        Remove from the history the snapshots older than the
+        history_compact_days option that are identical to the previous
+        snapshot of the same service, so reads at any date give the same
+        values. Older than history_daily_days, only the last snapshot of
+        each day is kept.
+        '''
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        compact_days = config.getint('nodux_technical_service',
+            'history_compact_days', default=30)
+        daily_days = config.getint('nodux_technical_service',
+            'history_daily_days', default=0)
+        if not compact_days:
+            return
+        now = datetime.datetime.now()
+        compact_limit = now - datetime.timedelta(days=compact_days)
+        daily_limit = (now - datetime.timedelta(days=daily_days)
+            if daily_days else None)
+
+        history = TableHandler(cursor, cls, history=True)
+        columns = []
+        for name, field in cls._fields.iteritems():
+            if (name in ('id', 'write_date', 'write_uid')
+                    or isinstance(field, (fields.Function, fields.One2Many,
+                            fields.Many2Many))
+                    or not history.column_exist(name)):
+                continue
+            if (field._type == 'binary'
+                    and backend.name() == 'postgresql'):
+                columns.append('MD5("%s")' % name)
+            else:
+                columns.append('"%s"' % name)
+        table = '%s__history' % cls._table
+
+        cursor.execute('SELECT DISTINCT "id" FROM "%s" '
+            'WHERE COALESCE("write_date", "create_date") < %%s' % table,
+            (compact_limit,))
+        record_ids = [r[0] for r in cursor.fetchall()]
+        for i in range(0, len(record_ids), cursor.IN_MAX):
+            sub_ids = record_ids[i:i + cursor.IN_MAX]
+            cursor.execute('SELECT "__id", '
+                'COALESCE("write_date", "create_date"), "id", %s '
+                'FROM "%s" WHERE "id" IN (%s) '
+                'ORDER BY "id", COALESCE("write_date", "create_date"), '
+                '"__id"' % (', '.join(columns), table,
+                    ','.join('%s' for _ in sub_ids)), sub_ids)
+            to_delete = []
+            previous = None
+            for row in cursor.fetchall():
+                history_id, date, values = row[0], row[1], row[2:]
+                if isinstance(date, basestring):
+                    date = datetime.datetime.strptime(date[:19],
+                        '%Y-%m-%d %H:%M:%S')
+                if previous and previous[2][0] == values[0]:
+                    if date < compact_limit and values == previous[2]:
+                        # Keep the first snapshot of identical ones
+                        to_delete.append(history_id)
+                        continue
+                    if (daily_limit and previous[1] < daily_limit
+                            and date.date() == previous[1].date()
+                            and values[1:] != (None,) * (len(values) - 1)):
+                        to_delete.append(previous[0])
+                previous = (history_id, date, values)
+            for j in range(0, len(to_delete), cursor.IN_MAX):
+                sub_delete = to_delete[j:j + cursor.IN_MAX]
+                cursor.execute('DELETE FROM "%s" WHERE "__id" IN (%s)' % (
+                        table, ','.join('%s' for _ in sub_delete)),
+                    sub_delete)
+            cursor.commit()
+
     @classmethod
     def delete(cls, services):
+        Change = Pool().get('service.service.change')
         cls.check_modify(services)
         for service in services:
             if (service.state in ('review', 'ready', 'without', 'warranty', 'delivered')):
                 cls.raise_user_error('delete_cancel', (service.number_service,))
+        Photo = Pool().get('service.service.photo')
+        changes = [(s.id, s.id) for s in services]
+        revenue_keys = [(s.company.id, s.entry_date) for s in services]
+        Photo.set_photos([s.id for s in services], None)
         super(Service, cls).delete(services)
+        Change.log(cls.__name__, changes, 'delete')
+        Pool().get('service.revenue.dirty').invalidate(revenue_keys)
 
     @classmethod
     @ModelView.button
     @Workflow.transition('review')
+    @instrumented('service.service.review')
     def review(cls, services):
-        for service in services:
-            service.set_number()
-
-        cls.write([i for i in services if i.state != 'review'], {
-                'state': 'review',
-                })
+        # Number and state are written together to save a write per service
+        to_write = []
+        args = []
+        # Number by sequence so batches draw from the sequences in the
+        # same order
+        sequences = dict((s.id, s.get_number_sequence()) for s in services
+            if not s.number_service)
+        for service in sorted(services, key=lambda s: (
+                    sequences[s.id].id if s.id in sequences else 0, s.id)):
+            vals = service.get_number_values(sequences.get(service.id))
+            if service.state != 'review':
+                vals['state'] = 'review'
+                to_write.append(service)
+            if vals:
+                args.extend(([service], vals))
+        if args:
+            cls.write(*args)
+        cls.enqueue_transition_jobs(to_write, 'review')
 
     @classmethod
     @ModelView.button
     @Workflow.transition('ready')
+    @instrumented('service.service.ready')
     def ready(cls, services):
-        cls.write([i for i in services if i.state != 'ready'], {
+        to_write = [i for i in services if i.state != 'ready']
+        cls.write(to_write, {
                 'state': 'ready',
                 })
+        cls.enqueue_transition_jobs(to_write, 'ready')
 
     @classmethod
     @ModelView.button
     @Workflow.transition('without')
+    @instrumented('service.service.without')
     def without(cls, services):
-        cls.write([i for i in services if i.state != 'without'], {
+        to_write = [i for i in services if i.state != 'without']
+        cls.write(to_write, {
                 'state': 'without',
                 })
+        cls.enqueue_transition_jobs(to_write, 'without')
 
     @classmethod
     @ModelView.button
     @Workflow.transition('warranty')
+    @instrumented('service.service.warranty')
     def warranty(cls, services):
-        cls.write([i for i in services if i.state != 'warranty'], {
+        to_write = [i for i in services if i.state != 'warranty']
+        cls.write(to_write, {
                 'state': 'warranty',
                 })
+        cls.enqueue_transition_jobs(to_write, 'warranty')
 
     @classmethod
     @ModelView.button
     @Workflow.transition('delivered')
+    @instrumented('service.service.delivered')
     def delivered(cls, services):
-        cls.write([i for i in services if i.state != 'delivered'], {
+        to_write = [i for i in services if i.state != 'delivered']
+        cls.write(to_write, {
                 'state': 'delivered',
                 })
+        cls.enqueue_transition_jobs(to_write, 'delivered')
 
     @classmethod
+    @instrumented('service.service.search_text')
+    def search_text(cls, text, limit=20):
+        '''
+        Return the services matching text in observations, accessories,
+        repair detail, line failures or history descriptions, best ranked
+        first with the matching fragments.
+        '''
+        if not text:
+            return []
+        if backend.name() != 'postgresql':
+            return cls._search_text_like(text, limit)
+        pool = Pool()
+        Line = pool.get('service.service.line')
+        History = pool.get('service.service.history_lines')
+        Archive = pool.get('service.service.archive')
+        cursor = Transaction().cursor
+
+        sources = [(cls, 'id'), (Line, 'service'), (History, 'service')]
+        if Transaction().context.get('service_archive', True):
+            sources += [(Archive, 'id'),
+                (pool.get('service.service.line.archive'), 'service'),
+                (pool.get('service.service.history_lines.archive'),
+                    'service')]
+        matches = []
+        for Model, key in sources:
+            document = fts_document(FTS_FIELDS[Model.__name__])
+            matches.append('SELECT "%s" AS service, '
+                'ts_rank(%s, q.tsq) AS rank FROM "%s", q '
+                'WHERE %s @@ q.tsq' % (key, document, Model._table, document))
+        cursor.execute('WITH q AS (SELECT plainto_tsquery(%s, %s) AS tsq) '
+            'SELECT service, SUM(rank) AS rank '
+            'FROM (' + ' UNION ALL '.join(matches) + ') AS matches '
+            'WHERE service IS NOT NULL '
+            'GROUP BY service ORDER BY rank DESC LIMIT %s',
+            (FTS_CONFIG, text, limit))
+        ranks = dict(cursor.fetchall())
+        # Apply the access rules of the user
+        services = cls.search([('id', 'in', ranks.keys())])
+        hot_ids = set(s.id for s in services)
+        services += Archive.search([
+                ('id', 'in', [i for i in ranks if i not in hot_ids]),
+                ])
+        if not services:
+            return []
+
+        snippets = dict((s.id, []) for s in services)
+        for Model, key in sources:
+            cursor.execute('WITH q AS (SELECT plainto_tsquery(%%s, %%s) AS tsq) '
+                'SELECT "%s", ts_headline(%%s, %s, q.tsq, %%s) '
+                'FROM "%s", q WHERE "%s" IN (%s) AND %s @@ q.tsq' % (
+                    key, fts_text(FTS_FIELDS[Model.__name__]), Model._table,
+                    key, ','.join(str(s.id) for s in services),
+                    fts_document(FTS_FIELDS[Model.__name__])),
+                (FTS_CONFIG, text, FTS_CONFIG,
+                    'MaxFragments=2, StartSel=<b>, StopSel=</b>'))
+            for service_id, snippet in cursor.fetchall():
+                snippets[service_id].append(snippet)
+
+        result = [cls._search_text_result(s, ranks[s.id], snippets[s.id])
+            for s in services]
+        result.sort(key=lambda r: r['rank'], reverse=True)
+        return result
+
+    @classmethod
+    def _search_text_like(cls, text, limit):
+        'Fallback of search_text for backends without full-text search'
+        pattern = '%' + text + '%'
+        fields_names = FTS_FIELDS[cls.__name__]
+        domain = ['OR',
+            ('lines.failure', 'ilike', pattern),
+            ('history_lines.description', 'ilike', pattern),
+            ] + [(f, 'ilike', pattern) for f in fields_names]
+        order = [('entry_date', 'DESC')]
+        services = cls.search(domain, limit=limit, order=order)
+        if Transaction().context.get('service_archive', True):
+            Archive = Pool().get('service.service.archive')
+            services += Archive.search(domain, limit=limit, order=order)
+            services.sort(key=lambda s: s.entry_date, reverse=True)
+            services = services[:limit]
+        lower = text.lower()
+        result = []
+        for service in services:
+            values = [getattr(service, f) for f in fields_names]
+            values += [l.failure for l in service.lines]
+            values += [h.description for h in service.history_lines]
+            snippets = []
+            for value in values:
+                index = (value or '').lower().find(lower)
+                if index < 0:
+                    continue
+                start = max(index - 30, 0)
+                end = index + len(text)
+                snippets.append(value[start:index] + '<b>'
+                    + value[index:end] + '</b>' + value[end:end + 30])
+            result.append(cls._search_text_result(service, len(snippets),
+                    snippets))
+        return result
+
+    @staticmethod
+    def _search_text_result(service, rank, snippets):
+        return {
+            'id': service.id,
+            'number_service': service.number_service,
+            'party': service.party.rec_name,
+            'entry_date': service.entry_date,
+            'state': service.state,
+            'rank': rank,
+            'snippets': snippets,
+            }
+
+    @classmethod
+    def get_instrumentation(cls, name=None):
+        '''
+        Return the query count, rows, SQL and Python time measured in this
+        process by entry point.
+        '''
+        return get_statistics(name)
+
+    @classmethod
+    def batch_transition(cls, transition, ids, chunk_size=None):
+        '''
+        Apply transition to the services by chunks, committing each chunk.
+        A chunk that fails is rolled back to its savepoint and retried
+        service by service so only the failing services are left behind.
+        Return the ids done and the errors by service.
+        '''
+        buttons = ('review', 'ready', 'without', 'warranty', 'delivered')
+        if transition not in buttons:
+            cls.raise_user_error('unknown_transition', (transition,))
+        cursor = Transaction().cursor
+        chunk_size = chunk_size or config.getint('nodux_technical_service',
+            'transition_chunk', default=50)
+        method = getattr(cls, transition)
+
+        done, errors = [], []
+        for i in xrange(0, len(ids), chunk_size):
+            services = []
+            for service in cls.browse(ids[i:i + chunk_size]):
+                if (service.state != transition
+                        and (service.state, transition)
+                        not in cls._transitions):
+                    errors.append(cls._batch_error(service,
+                            cls.raise_user_error('invalid_transition', {
+                                    'service': service.rec_name,
+                                    'from': service.state,
+                                    'to': transition,
+                                    }, raise_exception=False)))
+                else:
+                    services.append(service)
+            try:
+                with savepoint():
+                    method(services)
+                done.extend(s.id for s in services)
+            except Exception:
+                for service in cls.browse([s.id for s in services]):
+                    try:
+                        with savepoint():
+                            method([service])
+                        done.append(service.id)
+                    except Exception, exception:
+                        errors.append(cls._batch_error(service,
+                                getattr(exception, 'message', None)
+                                or unicode(exception)))
+            cursor.commit()
+        return {
+            'done': done,
+            'errors': errors,
+            }
+
+    @staticmethod
+    def _batch_error(service, message):
+        return {
+            'id': service.id,
+            'number_service': service.number_service,
+            'error': message,
+            }
+
+    @classmethod
+    def enqueue_transition_jobs(cls, services, state):
+        Job = Pool().get('service.job')
+        for method in cls._transition_jobs.get(state, []):
+            Job.enqueue(services, method)
+
+    @classmethod
+    def get_intake_snapshot(cls):
+        '''
+        Return what a counter needs to draft services offline: the
+        periferics, brands, work products with their cost price, technicians
+        of the company, parties of the recent services and default dates.
+        '''
+        pool = Pool()
+        Periferic = pool.get('service.periferic')
+        Brand = pool.get('product.brand')
+        Product = pool.get('product.product')
+        Employee = pool.get('company.employee')
+        Party = pool.get('party.party')
+        Date = pool.get('ir.date')
+        cursor = Transaction().cursor
+        service = cls.__table__()
+
+        company = Transaction().context.get('company')
+        today = Date.today()
+        days = config.getint('nodux_technical_service', 'intake_party_days',
+            default=90)
+        cursor.execute(*service.select(service.party,
+                where=(service.company == company)
+                & (service.entry_date >= today - datetime.timedelta(days=days)),
+                group_by=[service.party]))
+        party_ids = [r[0] for r in cursor.fetchall()]
+
+        product_names = Product.get_name_catalog()
+        employee_names = Employee.get_name_catalog()
+        return {
+            'date': today,
+            'delivery_date': cls.default_delivery_date(),
+            'periferics': sorted(Periferic.get_name_catalog().items()),
+            'brands': sorted(Brand.get_name_catalog().items()),
+            'products': [(p.id, product_names.get(p.id), p.cost_price)
+                for p in Product.search([('type', '=', 'service')])],
+            'technicians': [(e.id, employee_names.get(e.id))
+                for e in Employee.search([('company', '=', company)])],
+            'parties': [(p.id, p.vat_number, p.name)
+                for p in Party.browse(party_ids)],
+            }
+
+    @classmethod
+    def submit_drafts(cls, drafts):
+        '''
+        Create the services drafted offline with their lines in one
+        transaction. A draft already submitted with the same intake
+        reference returns its service instead of a duplicate, a reference
+        repeated in drafts is reported as an error and a draft that fails is
+        rolled back alone and reported with its error.
+        '''
+        pool = Pool()
+        Archive = pool.get('service.service.archive')
+        cursor = Transaction().cursor
+
+        references = [d['intake_reference'] for d in drafts
+            if d.get('intake_reference')]
+        existing = {}
+        for Model in (cls, Archive):
+            for i in range(0, len(references), cursor.IN_MAX):
+                for record in Model.search([
+                            ('intake_reference', 'in',
+                                references[i:i + cursor.IN_MAX]),
+                            ]):
+                    existing[record.intake_reference] = record.id
+
+        created, errors = [], []
+        seen = set()
+        for draft in drafts:
+            reference = draft.get('intake_reference')
+            if reference in existing and reference not in seen:
+                seen.add(reference)
+                continue
+            try:
+                with savepoint():
+                    if not reference:
+                        cls.raise_user_error('missing_intake_reference')
+                    if reference in seen:
+                        cls.raise_user_error('duplicate_intake_reference',
+                            (reference,))
+                    seen.add(reference)
+                    service, = cls.create([cls._draft_values(draft)])
+            except Exception, exception:
+                errors.append({
+                        'intake_reference': reference,
+                        'error': (getattr(exception, 'message', None)
+                            or unicode(exception)),
+                        })
+                continue
+            existing[reference] = service.id
+            created.append(reference)
+        return {
+            'created': dict((r, existing[r]) for r in created),
+            'existing': dict((r, existing[r]) for r in references
+                if r in existing and r not in created),
+            'errors': errors,
+            }
+
+    @classmethod
+    def _draft_values(cls, draft):
+        'Return the values to create the service drafted offline'
+        Party = Pool().get('party.party')
+        values = dict((k, v) for k, v in draft.iteritems()
+            if k in cls._intake_fields)
+        if not values.get('party') and draft.get('vat_number'):
+            parties = Party.search([
+                    ('vat_number', '=', draft['vat_number']),
+                    ], limit=1)
+            if not parties:
+                cls.raise_user_error('unknown_party', (draft['vat_number'],))
+            values['party'] = parties[0].id
+        values['lines'] = [('create', [dict((k, v)
+                        for k, v in line.iteritems()
+                        if k in cls._intake_line_fields)
+                    for line in draft.get('lines', [])])]
+        return values
+
+    @classmethod
+    @instrumented('service.service.getTechnicalService')
     def getTechnicalService(cls, identificacion):
         print "Establece la conexion ", identificacion
         pool = Pool()
         Service = pool.get('service.service')
         Party = pool.get('party.party')
+        Periferic = pool.get('service.periferic')
+        Brand = pool.get('product.brand')
+        Employee = pool.get('company.employee')
+        periferics = Periferic.get_name_catalog()
+        brands = Brand.get_name_catalog()
+        employees = Employee.get_name_catalog()
         parties = Party.search([('vat_number', '=', identificacion)])
         for p in parties:
             party = p
@@ -402,12 +1137,12 @@ class Service(Workflow, ModelSQL, ModelView):
                     lines_services[0] = service.entry_date.strftime('%d/%m/%Y')
                     lines_services[1]= service.delivery_date.strftime('%d/%m/%Y')
                     lines_services[2] = service.number_service
-                    lines_services[3] = line.periferic.name
-                    lines_services[4] = line.trademark.name
+                    lines_services[3] = periferics.get(line.periferic.id)
+                    lines_services[4] = brands.get(line.trademark.id)
                     lines_services[5] = line.model
                     lines_services[6] = line.failure
                     lines_services[7] = str(line.reference_amount)
-                    lines_services[8] = line.technical.party.name
+                    lines_services[8] = employees.get(line.technical.id)
                     lines_services[9] = service.state
                     lines_services[10] = service.accessories
                     lines_services[11] = service.detail
@@ -432,6 +1167,11 @@ class ServiceLine(ModelSQL, ModelView):
     failure = fields.Text('Failure', required = True)
     reference_amount = fields.Numeric('Reference Amount')
     technical = fields.Many2One('company.employee', 'Technical', required = True)
+    periferic_name = fields.Function(fields.Char('Periferic'),
+        'get_periferic_name', searcher='search_periferic_name')
+    fingerprint = fields.Char('Fingerprint', readonly=True, select=True)
+    previous_services = fields.Function(fields.One2Many('service.service',
+            None, 'Previous Services'), 'on_change_with_previous_services')
     #type_work = fields.Many2One('service.type_work', 'Type Work')
 
     @classmethod
@@ -441,15 +1181,106 @@ class ServiceLine(ModelSQL, ModelView):
                 'modify': ('You can not modify line "%(line)s" from service '
                     '"%(invoice)s".'),
                 'create': ('You can not add a line to service "%(invoice)s."'),
+                'invalid_grouping': ('Revenue can not be grouped by "%s".'),
+                })
+        cls.__rpc__.update({
+                'get_revenue': RPC(),
+                'find_previous_services': RPC(),
                 })
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+        fingerprint_exist = table.column_exist('fingerprint')
+
+        super(ServiceLine, cls).__register__(module_name)
+        register_fts_index(cls)
+
+        if not fingerprint_exist:
+            backfill_fingerprint(cls)
+
     @staticmethod
     def default_series():
         return "S/S"
 
+    @classmethod
+    def read(cls, ids, fields_names=None):
+        Archive = Pool().get('service.service.line.archive')
+        return Archive.read_with_archive(cls, ids, fields_names,
+            super(ServiceLine, cls).read)
+
+    @classmethod
+    def get_periferic_name(cls, lines, name):
+        Periferic = Pool().get('service.periferic')
+        names = Periferic.get_name_catalog()
+        return dict((l.id, names.get(l.periferic.id) if l.periferic else None)
+            for l in lines)
+
+    @fields.depends('periferic')
+    def on_change_with_periferic_name(self, name=None):
+        Periferic = Pool().get('service.periferic')
+        if self.periferic:
+            return Periferic.get_name_catalog().get(self.periferic.id)
+
+    @classmethod
+    def search_periferic_name(cls, name, clause):
+        return [('periferic.name',) + tuple(clause[1:])]
+
+    @classmethod
+    def order_periferic_name(cls, tables):
+        return cls._fields['periferic'].convert_order('periferic', tables,
+            cls)
+
+    @fields.depends('trademark', 'model', 'series', 'service')
+    def on_change_with_previous_services(self, name=None):
+        return self.previous_service_ids(
+            device_fingerprint(self.trademark, self.model, self.series),
+            exclude=self.service.id if self.service else None)
+
+    @classmethod
+    def previous_service_ids(cls, fingerprint, exclude=None):
+        'Return the ids of the services of the device, newest first'
+        if not fingerprint:
+            return []
+        pool = Pool()
+        cursor = Transaction().cursor
+        rows = []
+        for service_name, line_name in (
+                ('service.service', 'service.service.line'),
+                ('service.service.archive', 'service.service.line.archive')):
+            service = pool.get(service_name).__table__()
+            line = pool.get(line_name).__table__()
+            cursor.execute(*line.join(service,
+                    condition=line.service == service.id
+                    ).select(service.id, service.entry_date,
+                    where=line.fingerprint == fingerprint))
+            rows.extend(cursor.fetchall())
+        rows.sort(key=lambda r: (r[1], r[0]), reverse=True)
+        ids = []
+        for service_id, _ in rows:
+            if service_id != exclude and service_id not in ids:
+                ids.append(service_id)
+        return ids
+
+    @classmethod
+    def find_previous_services(cls, trademark, model, series):
+        '''
+        Return the number, dates, state, garanty and party of the services
+        entered before for the device, newest first.
+        '''
+        Service = Pool().get('service.service')
+        ids = cls.previous_service_ids(
+            device_fingerprint(trademark, model, series))
+        services = Service.read(ids, ['number_service', 'entry_date',
+                'delivery_date', 'state', 'garanty', 'party'])
+        return sorted(services, key=lambda s: ids.index(s['id']))
+
     @fields.depends('product', '_parent_service.party',
         '_parent_service.currency',
         'party', 'currency', 'service', 'reference_amount')
+    @instrumented('service.service.line.on_change_product')
     def on_change_product(self):
         pool = Pool()
         Product = pool.get('product.product')
@@ -486,16 +1317,54 @@ class ServiceLine(ModelSQL, ModelView):
                         'invoice': line.service.number_service
                         })
 
+    @staticmethod
+    def _revenue_keys(lines):
+        return set((l.service.company.id, l.service.entry_date)
+            for l in lines if l.service)
+
     @classmethod
     def delete(cls, lines):
+        pool = Pool()
+        Change = pool.get('service.service.change')
+        RevenueDirty = pool.get('service.revenue.dirty')
         cls.check_modify(lines)
+        changes = [(l.id, l.service.id if l.service else None)
+            for l in lines]
+        revenue_keys = cls._revenue_keys(lines)
         super(ServiceLine, cls).delete(lines)
+        Change.log(cls.__name__, changes, 'delete')
+        RevenueDirty.invalidate(revenue_keys)
 
     @classmethod
     def write(cls, *args):
+        pool = Pool()
+        Change = pool.get('service.service.change')
+        RevenueDirty = pool.get('service.revenue.dirty')
         lines = sum(args[0::2], [])
         cls.check_modify(lines)
+        revenue_keys = cls._revenue_keys(lines)
         super(ServiceLine, cls).write(*args)
+        if any('service' in v for v in args[1::2]):
+            lines = cls.browse([l.id for l in lines])
+            revenue_keys |= cls._revenue_keys(lines)
+        RevenueDirty.invalidate(revenue_keys)
+        cls.set_fingerprint(args)
+        Change.log(cls.__name__, [(l.id, l.service.id if l.service else None)
+                for l in lines], 'write')
+
+    @classmethod
+    def set_fingerprint(cls, args):
+        'Update the fingerprint of the lines written with args'
+        fingerprints = defaultdict(list)
+        actions = iter(args)
+        for lines, values in zip(actions, actions):
+            if not set(values) & set(['trademark', 'model', 'series']):
+                continue
+            for line in cls.browse([l.id for l in lines]):
+                fingerprints[device_fingerprint(line.trademark, line.model,
+                        line.series)].append(line)
+        for fingerprint, lines in fingerprints.iteritems():
+            super(ServiceLine, cls).write(lines, {'fingerprint': fingerprint})
 
     @classmethod
     def create(cls, vlist):
@@ -507,7 +1376,50 @@ class ServiceLine(ModelSQL, ModelView):
         for service in Service.browse(service_ids):
             if service.state in ('ready', 'without', 'warranty', 'delivered'):
                 cls.raise_user_error('create', (service.number_service,))
-        return super(ServiceLine, cls).create(vlist)
+        vlist = [v.copy() for v in vlist]
+        for values in vlist:
+            values['fingerprint'] = device_fingerprint(
+                values.get('trademark'), values.get('model'),
+                values.get('series'))
+        lines = super(ServiceLine, cls).create(vlist)
+        Change = Pool().get('service.service.change')
+        RevenueDirty = Pool().get('service.revenue.dirty')
+        Change.log(cls.__name__, [(l.id, l.service.id if l.service else None)
+                for l in lines], 'create')
+        RevenueDirty.invalidate(cls._revenue_keys(lines))
+        return lines
+
+    @classmethod
+    def get_revenue(cls, start_date, end_date, grouping=None):
+        '''
+        Return the sum of the reference amounts and the number of lines of
+        the services of the company entered between the dates, grouped by
+        any of year, month, type, product, periferic and trademark.
+        '''
+        pool = Pool()
+        Rollup = pool.get('service.revenue.rollup')
+        grouping = list(grouping or [])
+        for name in grouping:
+            if name not in GROUPING:
+                cls.raise_user_error('invalid_grouping', (name,))
+        company = Transaction().context.get('company')
+        rows = Rollup.aggregate(company, start_date, end_date, grouping)
+
+        catalogs = {}
+        for name, model in (('product', 'product.product'),
+                ('periferic', 'service.periferic'),
+                ('trademark', 'product.brand')):
+            if name in grouping:
+                catalogs[name] = pool.get(model).get_name_catalog()
+        result = []
+        for key, (amount, quantity) in sorted(rows.iteritems()):
+            values = dict(zip(grouping, key))
+            for name, names in catalogs.iteritems():
+                values[name + '_name'] = names.get(values[name])
+            values['amount'] = amount
+            values['quantity'] = quantity
+            result.append(values)
+        return result
 
 class HistoryLine(ModelSQL, ModelView):
     'History Line'
@@ -534,10 +1446,22 @@ class HistoryLine(ModelSQL, ModelView):
                     '"%(invoice)s"'),
                 'create': ('You can not add a line to history "%(invoice)s" '),
                 })
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(HistoryLine, cls).__register__(module_name)
+        register_fts_index(cls)
+
     @staticmethod
     def default_date():
         return datetime.datetime.now()
 
+    @classmethod
+    def read(cls, ids, fields_names=None):
+        Archive = Pool().get('service.service.history_lines.archive')
+        return Archive.read_with_archive(cls, ids, fields_names,
+            super(HistoryLine, cls).read)
+
     def hash_password(self, password):
         if not password:
             return ''
@@ -590,6 +1514,7 @@ class HistoryLine(ModelSQL, ModelView):
         return hash_ == bcrypt.hashpw(password, hash_)
 
     @fields.depends('description', 'password')
+    @instrumented('service.service.history_lines.on_change_password')
     def on_change_password(self):
         res = {}
         User = Pool().get('res.user')
@@ -624,8 +1549,25 @@ class HistoryLine(ModelSQL, ModelView):
                         'invoice': line.service.number_service
                         })
 
+    @classmethod
+    def create(cls, vlist):
+        Change = Pool().get('service.service.change')
+        lines = super(HistoryLine, cls).create(vlist)
+        Change.log(cls.__name__, [(l.id, l.service.id if l.service else None)
+                for l in lines], 'create')
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        Change = Pool().get('service.service.change')
+        lines = sum(args[0::2], [])
+        super(HistoryLine, cls).write(*args)
+        Change.log(cls.__name__, [(l.id, l.service.id if l.service else None)
+                for l in lines], 'write')
+
     @classmethod
     def delete(cls, lines):
+        Change = Pool().get('service.service.change')
         cls.check_modify(lines)
         for line in lines:
             if (line.service and line.service.state in ('review', 'ready', 'without', 'warranty', 'delivered')):
@@ -633,7 +1575,10 @@ class HistoryLine(ModelSQL, ModelView):
                         'line': line.rec_name,
                         'invoice': line.service.number_service
                         })
+        changes = [(l.id, l.service.id if l.service else None)
+            for l in lines]
         super(HistoryLine, cls).delete(lines)
+        Change.log(cls.__name__, changes, 'delete')
 
 class ServiceReport(Report):
     __name__ = 'service.service'
@@ -644,6 +1589,7 @@ class ServiceReport(Report):
         cls.__rpc__['execute'] = RPC(False)
 
     @classmethod
+    @instrumented('service.service.report.execute')
     def execute(cls, ids, data):
         Service = Pool().get('service.service')
 
@@ -658,8 +1604,7 @@ class ServiceReport(Report):
 
     @classmethod
     def _get_records(cls, ids, model, data):
-        with Transaction().set_context(language=False):
-            return super(ServiceReport, cls)._get_records(ids[:1], model, data)
+        return super(ServiceReport, cls)._get_records(ids[:1], model, data)
 
     @classmethod
     def parse(cls, report, records, data, localcontext):
@@ -671,6 +1616,14 @@ class ServiceReport(Report):
 
         user = User(Transaction().user)
         localcontext['company'] = user.company
+        localcontext['periferic_names'] = pool.get(
+            'service.periferic').get_name_catalog()
+        localcontext['brand_names'] = pool.get(
+            'product.brand').get_name_catalog()
+        localcontext['product_names'] = pool.get(
+            'product.product').get_name_catalog()
+        localcontext['technical_names'] = pool.get(
+            'company.employee').get_name_catalog()
         return super(ServiceReport, cls).parse(report, records, data,
                 localcontext=localcontext)
 
@@ -713,6 +1666,6 @@ class DraftService(Wizard):
         if not in_group():
             self.raise_user_error("No esta autorizado a reversar un Servicio")
 
-        for service in services:
-            service.state = 'review'
-            service.save()
+        Service.write(list(services), {
+                'state': 'review',
+                })
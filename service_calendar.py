@@ -0,0 +1,214 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+import datetime
+from array import array
+from bisect import bisect_left, bisect_right
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.cache import Cache
+
+__all__ = ['ServiceCalendar', 'ServiceCalendarHoliday']
+
+_WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+    'saturday', 'sunday']
+
+
+class ServiceCalendar(ModelSQL, ModelView):
+    'Service Calendar'
+    __name__ = 'service.calendar'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        select=True)
+    monday = fields.Boolean('Monday')
+    tuesday = fields.Boolean('Tuesday')
+    wednesday = fields.Boolean('Wednesday')
+    thursday = fields.Boolean('Thursday')
+    friday = fields.Boolean('Friday')
+    saturday = fields.Boolean('Saturday')
+    sunday = fields.Boolean('Sunday')
+    holidays = fields.One2Many('service.calendar.holiday', 'calendar',
+        'Holidays')
+    service_days = fields.Integer('Service Days', required=True,
+        help='Business days to deliver a service')
+    home_service_days = fields.Integer('Home Service Days', required=True,
+        help='Business days to deliver a home service')
+    # Sorted ordinals of the business days around today by calendar
+    _days_cache = Cache('service.calendar.business_days', context=False)
+    _company_cache = Cache('service.calendar.company', context=False)
+    # Years before and after today covered by the business days
+    _span = 5
+
+    @classmethod
+    def __setup__(cls):
+        super(ServiceCalendar, cls).__setup__()
+        cls._sql_constraints += [
+            ('company_uniq', 'UNIQUE(company)',
+                'There can be only one calendar per company.'),
+            ]
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_monday():
+        return True
+
+    @staticmethod
+    def default_tuesday():
+        return True
+
+    @staticmethod
+    def default_wednesday():
+        return True
+
+    @staticmethod
+    def default_thursday():
+        return True
+
+    @staticmethod
+    def default_friday():
+        return True
+
+    @staticmethod
+    def default_saturday():
+        return False
+
+    @staticmethod
+    def default_sunday():
+        return False
+
+    @staticmethod
+    def default_service_days():
+        return 1
+
+    @staticmethod
+    def default_home_service_days():
+        return 1
+
+    def get_rec_name(self, name):
+        return self.company.rec_name
+
+    @classmethod
+    def get_calendar(cls, company_id):
+        'Return the calendar of the company or None'
+        if not company_id:
+            return None
+        calendar_id = cls._company_cache.get(company_id, -1)
+        if calendar_id == -1:
+            calendars = cls.search([('company', '=', company_id)], limit=1)
+            calendar_id = calendars[0].id if calendars else None
+            cls._company_cache.set(company_id, calendar_id)
+        return cls(calendar_id) if calendar_id else None
+
+    def get_sla_days(self, type_):
+        return getattr(self, type_ + '_days') or 0
+
+    def _is_business_day(self, date, holidays):
+        return (getattr(self, _WEEKDAYS[date.weekday()])
+            and date.toordinal() not in holidays)
+
+    def get_business_days(self):
+        'Return the sorted array of the business day ordinals'
+        days = self._days_cache.get(self.id)
+        if days is None:
+            Date = Pool().get('ir.date')
+            today = Date.today()
+            holidays = set(h.date.toordinal() for h in self.holidays)
+            start = datetime.date(today.year - self._span, 1, 1).toordinal()
+            end = datetime.date(today.year + self._span, 12, 31).toordinal()
+            days = array('i', (o for o in xrange(start, end + 1)
+                    if self._is_business_day(datetime.date.fromordinal(o),
+                        holidays)))
+            self._days_cache.set(self.id, days)
+        return days
+
+    def add_business_days(self, date, number):
+        'Return the date number business days after date'
+        if number <= 0:
+            return date
+        days = self.get_business_days()
+        index = bisect_right(days, date.toordinal()) + number - 1
+        if days and days[0] <= date.toordinal() and index < len(days):
+            return datetime.date.fromordinal(days[index])
+        # Outside of the precomputed span
+        holidays = set(h.date.toordinal() for h in self.holidays)
+        if not any(getattr(self, d) for d in _WEEKDAYS):
+            return date + datetime.timedelta(days=number)
+        while number > 0:
+            date += datetime.timedelta(days=1)
+            if self._is_business_day(date, holidays):
+                number -= 1
+        return date
+
+    def roll_forward(self, date):
+        'Return the first business day on or after date'
+        days = self.get_business_days()
+        index = bisect_left(days, date.toordinal())
+        if index < len(days) and days[0] <= date.toordinal():
+            return datetime.date.fromordinal(days[index])
+        return date
+
+    def business_days_overdue(self, due_date, date):
+        'Return the number of business days of date past due_date'
+        days = self.get_business_days()
+        due = self.roll_forward(due_date).toordinal()
+        if date.toordinal() <= due:
+            return 0
+        if not days or not (days[0] <= due and date.toordinal() <= days[-1]):
+            return date.toordinal() - due
+        return bisect_right(days, date.toordinal()) - bisect_right(days, due)
+
+    @classmethod
+    def clear_cache(cls):
+        cls._days_cache.clear()
+        cls._company_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        calendars = super(ServiceCalendar, cls).create(vlist)
+        cls.clear_cache()
+        return calendars
+
+    @classmethod
+    def write(cls, *args):
+        super(ServiceCalendar, cls).write(*args)
+        cls.clear_cache()
+
+    @classmethod
+    def delete(cls, calendars):
+        super(ServiceCalendar, cls).delete(calendars)
+        cls.clear_cache()
+
+
+class ServiceCalendarHoliday(ModelSQL, ModelView):
+    'Service Calendar Holiday'
+    __name__ = 'service.calendar.holiday'
+    calendar = fields.Many2One('service.calendar', 'Calendar', required=True,
+        ondelete='CASCADE', select=True)
+    date = fields.Date('Date', required=True)
+    name = fields.Char('Name')
+
+    @classmethod
+    def __setup__(cls):
+        super(ServiceCalendarHoliday, cls).__setup__()
+        cls._order.insert(0, ('date', 'ASC'))
+
+    @classmethod
+    def create(cls, vlist):
+        Calendar = Pool().get('service.calendar')
+        holidays = super(ServiceCalendarHoliday, cls).create(vlist)
+        Calendar.clear_cache()
+        return holidays
+
+    @classmethod
+    def write(cls, *args):
+        Calendar = Pool().get('service.calendar')
+        super(ServiceCalendarHoliday, cls).write(*args)
+        Calendar.clear_cache()
+
+    @classmethod
+    def delete(cls, holidays):
+        Calendar = Pool().get('service.calendar')
+        super(ServiceCalendarHoliday, cls).delete(holidays)
+        Calendar.clear_cache()